@@ -1,16 +1,90 @@
 from announcements import models
 from django.contrib import admin
+from django.utils import timezone
+
+
+class PolledSourceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_polled', 'next_poll_at',
+                    'consecutive_failures', 'circuit_state')
+    readonly_fields = ('next_poll_at', 'consecutive_failures', 'last_error',
+                       'last_failure_at')
+    actions = ['reset_failures']
+
+    def reset_failures(self, request, queryset):
+        queryset.update(
+            consecutive_failures=0,
+            next_poll_at=timezone.now(),
+        )
+    reset_failures.short_description = "Reset failures and poll now"
+
+
+class DestinationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'consecutive_failures', 'suspended',
+                    'suspended_at')
+    list_filter = ('suspended',)
+    readonly_fields = ('consecutive_failures', 'last_error', 'suspended_at')
+    actions = ['resume_delivery']
+
+    def resume_delivery(self, request, queryset):
+        # Save each one, rather than update(), so the routing table is
+        # rebuilt with them in it.
+        for destination in queryset:
+            destination.consecutive_failures = 0
+            destination.last_error = ''
+            destination.suspended = False
+            destination.suspended_at = None
+            destination.save()
+            # The failure that suspended it backed off its first message,
+            # which would hold up the rest.
+            models.Message.objects.filter(
+                source_routing__destination=destination,
+                sent=False,
+                dead=False,
+            ).update(next_attempt_at=timezone.now())
+    resume_delivery.short_description = "Clear failures and resume delivery"
+
+
+class SourceRoutingAdmin(admin.ModelAdmin):
+    list_select_related = tuple(
+        [f'source__{field}source'
+         for field in models.SOURCE_TO_FIELD.values()] +
+        [f'destination__{field}destination'
+         for field in models.DESTINATION_TO_FIELD.values()]
+    )
+
+
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'sent', 'sent_at', 'attempts',
+                    'next_attempt_at', 'dead')
+    list_select_related = tuple(
+        [f'announcement__{field}announcement'
+         for field in models.SOURCE_TO_FIELD.values()] +
+        [f'source_routing__destination__{field}destination'
+         for field in models.DESTINATION_TO_FIELD.values()]
+    )
+    list_filter = ('sent', 'dead')
+    readonly_fields = ('attempts', 'last_error', 'next_attempt_at',
+                       'claimed_by', 'lease_expires')
+    actions = ['retry_delivery']
+
+    def retry_delivery(self, request, queryset):
+        queryset.filter(sent=False).update(
+            attempts=0,
+            dead=False,
+            next_attempt_at=timezone.now(),
+        )
+    retry_delivery.short_description = "Retry delivery now"
 
 
 admin.site.register(models.ManualSource)
-admin.site.register(models.ForumSource)
-admin.site.register(models.BlogSource)
-admin.site.register(models.ExemplarSource)
-admin.site.register(models.SlackDestination)
-admin.site.register(models.SourceRouting)
+admin.site.register(models.ForumSource, PolledSourceAdmin)
+admin.site.register(models.BlogSource, PolledSourceAdmin)
+admin.site.register(models.ExemplarSource, PolledSourceAdmin)
+admin.site.register(models.SlackDestination, DestinationAdmin)
+admin.site.register(models.SourceRouting, SourceRoutingAdmin)
 admin.site.register(models.ManualAnnouncement)
 admin.site.register(models.ForumAnnouncement)
 admin.site.register(models.BlogAnnouncement)
 admin.site.register(models.ExemplarAnnouncement)
-admin.site.register(models.Message)
+admin.site.register(models.Message, MessageAdmin)
 admin.site.register(models.AdMessage)
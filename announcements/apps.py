@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class AnnouncementsConfig(AppConfig):
+    name = 'announcements'
+
+    def ready(self):
+        from announcements import signals  # noqa: F401
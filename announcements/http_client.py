@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def log_timing(response, *args, **kwargs):
+    logger.debug(
+        '%s %s -> %s in %.3fs',
+        response.request.method,
+        response.url,
+        response.status_code,
+        response.elapsed.total_seconds(),
+    )
+
+
+def get_session():
+    """
+    Return the requests Session shared by this process. Connections are pooled
+    and kept alive per host, so repeated posts to the same webhook host reuse
+    a connection instead of doing a fresh TCP and TLS handshake every time.
+    django-q forks its workers, and a pooled socket can't be shared across a
+    fork, so each process builds its own session the first time it's needed.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.hooks['response'].append(log_timing)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """
+    Make a request with the shared session. Every outbound request should go
+    through here, so that they all get a timeout, even if the caller doesn't
+    specify one.
+    """
+    if timeout is None:
+        timeout = settings.HTTP_TIMEOUT
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
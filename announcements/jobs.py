@@ -53,6 +53,11 @@ class BaseScheduledJob():
         except IndexError:
             return None
 
+    def get_last_result(self):
+        if self.task:
+            return self.task.result
+        return None
+
     def get_next_run(self):
         return self.object.next_run
 
@@ -95,7 +100,8 @@ class AnnouncementFetchJob(BaseScheduledJob):
 class MessageRouterJob(BaseScheduledJob):
     """
     Step 2 of the pipeline: Using the configured routing settings, create any
-    applicable Messages from Announcements.
+    applicable Messages from Announcements. New Announcements queue a task to
+    route and deliver themselves, so this mostly catches anything they missed.
     """
     name = 'route_announcements'
     func = 'announcements.workers.route_announcements'
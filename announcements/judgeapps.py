@@ -0,0 +1,131 @@
+import threading
+import uuid
+from urllib.parse import urlparse
+
+import mechanize
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+COOKIE_CACHE_KEY = 'judgeapps_session_cookies'
+COOKIE_CACHE_TIMEOUT = 60 * 60 * 24
+LOGIN_LOCK_KEY = 'judgeapps_session_login'
+LOGIN_LOCK_TIMEOUT = 60
+
+
+class JudgeAppsLoginError(Exception):
+    """
+    Raised when we can't log in to JudgeApps, or it still sends us to the login
+    page after we have.
+    """
+
+
+class JudgeAppsSession():
+    """
+    A mechanize Browser that is logged in to JudgeApps. The session cookies are
+    kept in the cache, so that every ForumSource in every worker process shares
+    a single login. If JudgeApps redirects a request to the login page, the
+    session has expired, so we log in again and retry the request.
+    """
+
+    def __init__(self):
+        self.cookiejar = mechanize.CookieJar()
+        self.browser = mechanize.Browser()
+        self.browser.set_handle_robots(False)
+        self.browser.set_cookiejar(self.cookiejar)
+        # Identifies the login that our cookies came from, so that we can tell
+        # whether somebody else has already replaced them.
+        self.login_id = None
+
+    @property
+    def login_url(self):
+        return settings.JUDGEAPPS_BASE_URL + '/accounts/login/'
+
+    def is_login_page(self, response):
+        return urlparse(response.geturl()).path ==\
+            urlparse(self.login_url).path
+
+    def load_cookies(self):
+        """
+        Load the shared session cookies from the cache. Returns False if there
+        aren't any.
+        """
+        cached = cache.get(COOKIE_CACHE_KEY)
+        if not cached:
+            return False
+        self.login_id, cookies = cached
+        self.cookiejar.clear()
+        for cookie in cookies:
+            self.cookiejar.set_cookie(cookie)
+        return True
+
+    def login(self, timeout=None):
+        stale_login_id = self.login_id
+        with cache.lock(LOGIN_LOCK_KEY, timeout=LOGIN_LOCK_TIMEOUT):
+            # Another thread or process may have logged in while we were
+            # waiting for the lock, in which case we can just use that session.
+            if self.load_cookies() and self.login_id != stale_login_id:
+                return
+
+            self.cookiejar.clear()
+            self.browser.open(self.login_url, timeout=timeout)
+            self.browser.select_form(nr=0)
+            self.browser["username"] = settings.JUDGEAPPS_USERNAME
+            self.browser["password"] = settings.JUDGEAPPS_PASSWORD
+            response = self.browser.open(self.browser.click(), timeout=timeout)
+            # A successful login redirects away from the login page, a failed
+            # one shows the form again. Don't share cookies from a failure.
+            if self.is_login_page(response):
+                self.cookiejar.clear()
+                self.login_id = None
+                raise JudgeAppsLoginError(
+                    f'Could not log in to JudgeApps as '
+                    f'{settings.JUDGEAPPS_USERNAME}')
+
+            self.login_id = uuid.uuid4().hex
+            cache.set(
+                COOKIE_CACHE_KEY,
+                (self.login_id, list(self.cookiejar)),
+                COOKIE_CACHE_TIMEOUT,
+            )
+
+    def request(self, url, headers=None, timeout=None):
+        try:
+            return self.browser.open(
+                mechanize.Request(url, headers=headers or {}),
+                timeout=timeout,
+            )
+        except mechanize.HTTPError as e:
+            # mechanize treats 304 Not Modified as an error, but for a
+            # conditional request it's the answer we're hoping for.
+            if e.code == 304:
+                return e
+            raise
+
+    def open(self, url, headers=None, timeout=None):
+        if self.login_id is None and not self.load_cookies():
+            self.login(timeout=timeout)
+        response = self.request(url, headers=headers, timeout=timeout)
+        if self.is_login_page(response):
+            self.login(timeout=timeout)
+            response = self.request(url, headers=headers, timeout=timeout)
+            # Otherwise the login page would be parsed as the feed, and its
+            # ETag kept for the next poll.
+            if self.is_login_page(response):
+                raise JudgeAppsLoginError(
+                    f'Still sent to the login page for {url} after logging in')
+        return response
+
+
+_local = threading.local()
+
+
+def get_session():
+    """
+    Return this thread's JudgeAppsSession. mechanize Browsers aren't thread
+    safe, so each fetch thread gets its own, but they all share the cookies.
+    """
+    if not hasattr(_local, 'session'):
+        _local.session = JudgeAppsSession()
+    return _local.session
@@ -0,0 +1,86 @@
+import re
+
+from announcements import http_client
+
+
+HTML_LANG_RE = re.compile(rb'<html[^>]*?\slang=["\']([^"\']+)["\']',
+                          re.IGNORECASE)
+
+# The <html> tag is right at the top of the document, so we never need more
+# than the first few KB to find it.
+HEAD_CHUNK_SIZE = 1024
+HEAD_MAX_BYTES = 16 * 1024
+
+
+def get_document_language(url, timeout=None):
+    """
+    Find the language declared by the <html lang="..."> attribute of a web
+    page. Only the start of the page is downloaded, we stop reading as soon as
+    we find the tag. Returns None if the page doesn't declare a language.
+    """
+    with http_client.get(url, stream=True, timeout=timeout) as res:
+        res.raise_for_status()
+        head = b''
+        for chunk in res.iter_content(HEAD_CHUNK_SIZE):
+            head += chunk
+            match = HTML_LANG_RE.search(head)
+            if match:
+                return match.group(1).decode('ascii', errors='replace')
+            if len(head) >= HEAD_MAX_BYTES:
+                break
+    return None
+
+
+def get_entry_language(entry, feed, timeout=None):
+    """
+    Work out the language of a feed entry. Translated blog posts share a feed
+    with the original, so the post's own page is the authority. If it doesn't
+    say, fall back to the language of the feed.
+    """
+    language = get_document_language(entry.link, timeout=timeout)
+    if not language:
+        language = feed.get('language')
+    if not language:
+        raise Exception("Can't find language code for blog post.")
+    return language
+
+
+def normalize_language_tag(tag):
+    """
+    Language tags are case insensitive, and some sites use underscores like
+    'de_DE', so compare them in the form 'de-de'.
+    """
+    return tag.strip().replace('_', '-').lower()
+
+
+def parse_language_tags(value):
+    """
+    Parse a comma separated list of language tags, like 'en-US,de-DE', into a
+    set of normalized tags.
+    """
+    return frozenset(normalize_language_tag(tag) for tag in value.split(',')
+                     if tag.strip())
+
+
+def language_tag_prefixes(language_tag):
+    """
+    A normalized language tag and every prefix of it, most specific first, so
+    'de-de-1996' gives 'de-de-1996', 'de-de' and 'de'. These are the language
+    ranges that match the tag, along with '*'.
+    """
+    subtags = normalize_language_tag(language_tag).split('-')
+    prefixes = ['-'.join(subtags[:i]) for i in range(len(subtags), 0, -1)]
+    return prefixes + ['*']
+
+
+def language_matches(language_tag, language_tags):
+    """
+    Whether an announcement in language_tag should go to a destination that
+    wants language_tags, a set from parse_language_tags. Announcements without
+    a language go everywhere. A destination that wants 'de' gets 'de-DE' and
+    'de-AT' too, but one that wants 'en-US' doesn't get 'en'.
+    """
+    if not language_tag:
+        return True
+    return any(prefix in language_tags
+               for prefix in language_tag_prefixes(language_tag))
@@ -0,0 +1,82 @@
+import hashlib
+import time
+
+from django.core.cache import cache, caches
+from django.core.management.base import BaseCommand
+
+from announcements import sanitize
+
+
+PARAGRAPH = (
+    '<p>The <strong>Comprehensive Rules</strong> update for the new set is '
+    'out, with changes to <a href="https://blogs.magicjudges.org/rules/">'
+    'layers</a> &amp; the stack. <em>Read it</em> before your next event!'
+    '</p>\n<ul><li>One</li><li>Two &mdash; <code>613.1</code></li></ul>\n'
+)
+
+
+class Command(BaseCommand):
+    help = "Measure the per-entry cost of converting feed HTML to Markdown: " \
+           "a cold conversion, a hit in the shared cache, and a hit in this " \
+           "process's LRU cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paragraphs', type=int, default=100,
+                            help="Size of the sample post, in paragraphs")
+        parser.add_argument('--number', type=int, default=20,
+                            help="Conversions per measurement")
+        parser.add_argument('--file',
+                            help="Use the HTML in this file as the sample")
+
+    def measure(self, func, number, before=None):
+        """
+        Average time of func, calling before, untimed, ahead of each call.
+        """
+        total = 0
+        for _ in range(number):
+            if before:
+                before()
+            started = time.perf_counter()
+            func()
+            total += time.perf_counter() - started
+        return total / number
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file']) as f:
+                value = f.read()
+        else:
+            value = PARAGRAPH * options['paragraphs']
+        number = options['number']
+        key = sanitize.CACHE_KEY_PREFIX +\
+            hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+        def clear_local():
+            with sanitize._local_cache_lock:
+                sanitize._local_cache.clear()
+
+        def clear_all():
+            clear_local()
+            cache.delete(key)
+
+        def convert():
+            sanitize.html_to_markdown(value)
+
+        # Nothing cached anywhere, so this converts, and fills both caches.
+        cold = self.measure(convert, number, before=clear_all)
+        # Another worker converted it, so it's only in the shared cache.
+        sanitize.html_to_markdown(value)
+        shared = self.measure(convert, number, before=clear_local)
+        # This process converted it recently.
+        sanitize.html_to_markdown(value)
+        local = self.measure(convert, number)
+        clear_all()
+
+        self.stdout.write(f"Sample size: {len(value)} characters")
+        self.stdout.write(
+            f"Cache backend: {caches['default'].__class__.__name__}")
+        self.stdout.write(f"Cold:         {cold * 1000:.3f} ms per entry")
+        self.stdout.write(f"Shared cache: {shared * 1000:.3f} ms per entry, "
+                          f"{cold / shared:.0f}x faster")
+        self.stdout.write(f"LRU cache:    {local * 1000:.3f} ms per entry, "
+                          f"{cold / local:.0f}x faster")
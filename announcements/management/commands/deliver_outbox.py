@@ -0,0 +1,39 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from announcements import workers
+
+
+class Command(BaseCommand):
+    help = "Deliver Messages from the outbox as soon as they are routed. " \
+           "Runs until it is stopped, alongside the qcluster, when " \
+           "DELIVERY_OUTBOX is enabled."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drain', action='store_true',
+                            help="Deliver what's waiting, then exit")
+
+    def handle(self, *args, **options):
+        if not settings.DELIVERY_OUTBOX:
+            raise CommandError("DELIVERY_OUTBOX is not enabled")
+
+        # Finish the batch in hand before stopping, so that nothing is left
+        # claimed until its lease runs out.
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: stop.set())
+
+        if not options['drain']:
+            self.stdout.write("Delivering from the outbox, "
+                              "press Ctrl-C to stop")
+        report = workers.deliver_outbox(sync=options['drain'],
+                                        stopping=stop.is_set)
+        self.stdout.write(
+            f"Sent {report.get('sent', 0)} messages, "
+            f"{report.get('deferred', 0)} deferred, "
+            f"{report.get('failed', 0)} failed, "
+            f"{report.get('dead', 0)} dead"
+        )
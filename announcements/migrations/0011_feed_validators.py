@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0010_auto_20191001_2238'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogsource',
+            name='etag',
+            field=models.CharField(blank=True, default='', help_text='ETag of the last feed response', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='blogsource',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', help_text='Last-Modified of the last feed response', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='forumsource',
+            name='etag',
+            field=models.CharField(blank=True, default='', help_text='ETag of the last feed response', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='forumsource',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', help_text='Last-Modified of the last feed response', max_length=64),
+        ),
+    ]
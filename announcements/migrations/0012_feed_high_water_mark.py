@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0011_feed_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogsource',
+            name='last_entry_datetime',
+            field=models.DateTimeField(blank=True, help_text="Publish time of the newest entry we've seen. Older entries are skipped without being checked.", null=True),
+        ),
+        migrations.AddField(
+            model_name='forumsource',
+            name='last_entry_datetime',
+            field=models.DateTimeField(blank=True, help_text="Publish time of the newest entry we've seen. Older entries are skipped without being checked.", null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:43
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def schedule_polled_sources(apps, schema_editor):
+    # Every source except manual ones gets polled, make them due right away.
+    MessageSource = apps.get_model('announcements', 'MessageSource')
+    MessageSource.objects.exclude(source_type='M').update(
+        next_poll_at=timezone.now(),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0012_feed_high_water_mark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagesource',
+            name='next_poll_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When this source is next due to be polled. Empty for sources that are never polled.', null=True),
+        ),
+        migrations.RunPython(schedule_polled_sources, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0013_messagesource_next_poll_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagesource',
+            name='consecutive_failures',
+            field=models.IntegerField(default=0, help_text='Number of polls in a row that have failed'),
+        ),
+        migrations.AddField(
+            model_name='messagesource',
+            name='last_error',
+            field=models.TextField(blank=True, default='', help_text='Error from the most recent failed poll'),
+        ),
+        migrations.AddField(
+            model_name='messagesource',
+            name='last_failure_at',
+            field=models.DateTimeField(blank=True, help_text='Time of the most recent failed poll', null=True),
+        ),
+    ]
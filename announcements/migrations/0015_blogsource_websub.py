@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0014_messagesource_failures'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogsource',
+            name='websub_expires',
+            field=models.DateTimeField(blank=True, help_text='When our WebSub subscription runs out', null=True),
+        ),
+        migrations.AddField(
+            model_name='blogsource',
+            name='websub_hub',
+            field=models.URLField(blank=True, default='', help_text='WebSub hub advertised by the feed'),
+        ),
+        migrations.AddField(
+            model_name='blogsource',
+            name='websub_secret',
+            field=models.CharField(blank=True, default='', help_text='Secret used to sign content pushed by the hub', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='blogsource',
+            name='websub_topic',
+            field=models.URLField(blank=True, default='', help_text='WebSub topic URL of the feed'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:46
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def mark_old_announcements_routed(apps, schema_editor):
+    # The old router looked at every announcement every minute, so anything
+    # but the most recent announcements has certainly been routed already.
+    # Leave the recent ones for the router to double check.
+    Announcement = apps.get_model('announcements', 'Announcement')
+    Announcement.objects.filter(
+        created_at__lt=timezone.now() - datetime.timedelta(hours=1),
+    ).update(routed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0015_blogsource_websub'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcement',
+            name='routed',
+            field=models.BooleanField(db_index=True, default=False, help_text='Whether the router has created Messages for this announcement yet'),
+        ),
+        migrations.RunPython(mark_old_announcements_routed,
+                             migrations.RunPython.noop),
+    ]
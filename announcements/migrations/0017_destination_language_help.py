@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0016_announcement_routed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='destination',
+            name='language_tags',
+            field=models.CharField(default='en-US', help_text="Language codes to send to this destination. Only affects announcements that are generally translated, like Judge Blogs. Defaults to English. Select multiple languages using commas, like 'en-US,de-DE'. A code without a region, like 'de', matches every region.", max_length=200),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0017_destination_language_help'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attempts',
+            field=models.IntegerField(default=0, help_text='Failed delivery attempts so far.'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='dead',
+            field=models.BooleanField(default=False, help_text="Delivery failed too many times, and won't be retried."),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='last_error',
+            field=models.TextField(blank=True, help_text='The error from the most recent failed delivery attempt.'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When this message is next due to be delivered.'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sent', 'dead', 'next_attempt_at'], name='announcemen_sent_f5f293_idx'),
+        ),
+    ]
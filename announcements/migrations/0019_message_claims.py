@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0018_message_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='claimed_by',
+            field=models.CharField(blank=True, help_text='The delivery worker that is currently sending this message.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, help_text="When the current worker's claim on this message runs out, and another worker may take it over.", null=True),
+        ),
+    ]
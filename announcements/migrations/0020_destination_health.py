@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0019_message_claims'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='destination',
+            name='consecutive_failures',
+            field=models.IntegerField(default=0, help_text='Number of deliveries in a row that have failed'),
+        ),
+        migrations.AddField(
+            model_name='destination',
+            name='last_error',
+            field=models.TextField(blank=True, default='', help_text='Error from the most recent failed delivery'),
+        ),
+        migrations.AddField(
+            model_name='destination',
+            name='suspended',
+            field=models.BooleanField(db_index=True, default=False, help_text='Delivery failed permanently, nothing is routed or delivered here until this is cleared'),
+        ),
+        migrations.AddField(
+            model_name='destination',
+            name='suspended_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0020_destination_health'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogsource',
+            name='websub_callback_token',
+            field=models.CharField(blank=True, default='', help_text='Secret part of our callback URL, so that only the hub knows it', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='blogsource',
+            name='websub_pending_at',
+            field=models.DateTimeField(blank=True, help_text='When we last asked the hub to subscribe us, until the hub verifies it', null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:24
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_announcements(apps, schema_editor):
+    # Keep the first copy of each feed entry that was saved more than once.
+    Announcement = apps.get_model('announcements', 'Announcement')
+    feed_announcements = Announcement.objects.filter(
+        announcement_type__in=['F', 'B'],
+    )
+    duplicates = feed_announcements.values('source', 'url').annotate(
+        count=Count('id'),
+        first_id=Min('id'),
+    ).filter(count__gt=1)
+    for duplicate in duplicates:
+        feed_announcements.filter(
+            source=duplicate['source'],
+            url=duplicate['url'],
+        ).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0021_blogsource_websub_pending'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_announcements,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='announcement',
+            constraint=models.UniqueConstraint(condition=models.Q(announcement_type__in=['F', 'B']), fields=('source', 'url'), name='unique_feed_announcement_url'),
+        ),
+    ]
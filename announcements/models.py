@@ -1,22 +1,33 @@
-import bleach
+import copy
 import datetime
 import feedparser
-import html
+import hashlib
+import hmac
 import json
-from markdownify import markdownify
-import mechanize
+import logging
 import random
 import re
-import requests
+import secrets
+import time
+from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.humanize.templatetags.humanize import NaturalTimeFormatter
-from django.db import models
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.text import Truncator
 
+from announcements import (http_client, judgeapps, languages, ratelimit,
+                           sanitize)
+from announcements.process_cache import ProcessCache
+
+
+logger = logging.getLogger(__name__)
+
 
 class CreatedUpdatedMixin(models.Model):
     """
@@ -29,6 +40,165 @@ class CreatedUpdatedMixin(models.Model):
         abstract = True
 
 
+def resolve_subclasses(instances):
+    """
+    Load the subclass of each of a list of MessageSources, Destinations or
+    Announcements, with one query for each type rather than one for each
+    object, so that calling .subclass on them afterwards is free.
+    """
+    pending = {}
+    for instance in instances:
+        if instance._meta.parents:
+            # Already an instance of the subclass.
+            continue
+        try:
+            field = instance.subclass_field
+        except KeyError:
+            continue
+        related = getattr(instance.__class__, field).related
+        if not related.is_cached(instance):
+            pending.setdefault(related, []).append(instance)
+    for related, group in pending.items():
+        subclasses = related.related_model._base_manager.in_bulk(
+            [instance.pk for instance in group])
+        for instance in group:
+            if instance.pk in subclasses:
+                related.set_cached_value(instance, subclasses[instance.pk])
+    return instances
+
+
+class SubclassQuerySet(models.QuerySet):
+    """
+    QuerySet for the base models that have a subclass for each type. Calling
+    with_subclasses() loads the subclasses of the results in bulk, with
+    resolve_subclasses, when the QuerySet is evaluated.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._with_subclasses = False
+
+    def with_subclasses(self):
+        clone = self._chain()
+        clone._with_subclasses = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._with_subclasses = self._with_subclasses
+        return clone
+
+    def _fetch_all(self):
+        already_fetched = self._result_cache is not None
+        super()._fetch_all()
+        if self._with_subclasses and not already_fetched and\
+           issubclass(self._iterable_class, models.query.ModelIterable):
+            resolve_subclasses(self._result_cache)
+
+
+class FeedSourceMixin(models.Model):
+    """
+    Model Mixin for sources that poll an HTTP feed. Stores the validators from
+    the last response, so that we can make conditional requests and skip the
+    feed entirely when it hasn't changed, and a high-water mark so that we only
+    process entries that are actually new.
+    """
+    etag = models.CharField(
+        max_length=200, blank=True, default='',
+        help_text="ETag of the last feed response",
+    )
+    last_modified = models.CharField(
+        max_length=64, blank=True, default='',
+        help_text="Last-Modified of the last feed response",
+    )
+    last_entry_datetime = models.DateTimeField(
+        null=True, blank=True,
+        help_text="Publish time of the newest entry we've seen. Older entries "
+                  "are skipped without being checked.",
+    )
+
+    def get_conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def set_validators(self, headers):
+        self.etag = headers.get('ETag', '')
+        self.last_modified = headers.get('Last-Modified', '')
+
+    def get_new_entries(self, entries, date_format):
+        """
+        Return (datetime, entry) pairs for the feed entries that we haven't
+        seen before, newest first. We stop at the first entry older than our
+        high-water mark, and check the rest against the database with a single
+        query, so nothing expensive happens to entries we already have.
+        """
+        dated_entries = sorted(
+            ((datetime.datetime.strptime(entry.published, date_format), entry)
+             for entry in entries),
+            key=lambda pair: pair[0],
+            reverse=True,
+        )
+        candidates = []
+        for entry_datetime, entry in dated_entries:
+            if self.last_entry_datetime and\
+               entry_datetime < self.last_entry_datetime:
+                break
+            if entry_datetime < self.created_at:
+                break
+            candidates.append((entry_datetime, entry))
+        if not candidates:
+            return []
+
+        known_urls = set(Announcement.objects.filter(
+            source=self,
+            url__in=[entry.link for _, entry in candidates],
+        ).values_list('url', flat=True))
+        new_entries = []
+        for entry_datetime, entry in candidates:
+            if entry.link in known_urls:
+                continue
+            known_urls.add(entry.link)
+            new_entries.append((entry_datetime, entry))
+        return new_entries
+
+    def save_announcements(self, announcements, polled=True):
+        """
+        Save the new Announcements from a poll, along with the poll time and
+        the new high-water mark, in a single transaction. Announcements that
+        were pushed to us, rather than polled, only move the high-water mark
+        forward, so that they can't overwrite what a poll running at the same
+        time saves.
+        """
+        with transaction.atomic():
+            for announcement in announcements:
+                try:
+                    with transaction.atomic():
+                        announcement.save()
+                except IntegrityError:
+                    # Another poll or push saved this entry since we checked.
+                    logger.info('Skipping %s from %s, it was already saved',
+                                announcement.url, self)
+                if not self.last_entry_datetime or\
+                   announcement.post_datetime > self.last_entry_datetime:
+                    self.last_entry_datetime = announcement.post_datetime
+            if polled:
+                self.schedule_next_poll()
+                self.save()
+            elif self.last_entry_datetime:
+                self.__class__.objects.filter(
+                    models.Q(last_entry_datetime__isnull=True) |
+                    models.Q(last_entry_datetime__lt=self.last_entry_datetime),
+                    pk=self.pk,
+                ).update(last_entry_datetime=self.last_entry_datetime)
+
+    class Meta:
+        abstract = True
+
+
 SOURCE_TYPE_MANUAL = 'M'
 SOURCE_TYPE_APPS_FORUM = 'F'
 SOURCE_TYPE_BLOG = 'B'
@@ -75,15 +245,99 @@ class MessageSource(CreatedUpdatedMixin, models.Model):
                   "destinations.",
     )
 
+    next_poll_at = models.DateTimeField(
+        null=True, blank=True, db_index=True,
+        help_text="When this source is next due to be polled. Empty for "
+                  "sources that are never polled.",
+    )
+
+    consecutive_failures = models.IntegerField(
+        default=0,
+        help_text="Number of polls in a row that have failed",
+    )
+    last_error = models.TextField(
+        blank=True, default='',
+        help_text="Error from the most recent failed poll",
+    )
+    last_failure_at = models.DateTimeField(
+        null=True, blank=True,
+        help_text="Time of the most recent failed poll",
+    )
+
+    objects = SubclassQuerySet.as_manager()
+
     @property
     def type_detail(self):
         return self.get_source_type_display()
 
+    @property
+    def circuit_state(self):
+        """
+        Circuit breaker state of this source. A source that keeps failing is
+        'open', and is only retried every FETCH_BACKOFF_MAX minutes. Once that
+        retry is due, it's 'half-open', and one successful poll closes it.
+        """
+        if not self.consecutive_failures:
+            return 'closed'
+        threshold = settings.FETCH_CIRCUIT_BREAKER_THRESHOLD
+        if self.consecutive_failures < threshold:
+            return 'backing off'
+        if self.poll_due():
+            return 'half-open'
+        return 'open'
+
+    def poll_due(self):
+        return self.next_poll_at is not None and\
+            self.next_poll_at <= timezone.now()
+
+    def schedule_next_poll(self):
+        """
+        Record a successful poll, and schedule the next one. Only for
+        subclasses with a polling_interval and last_polled.
+        """
+        self.last_polled = timezone.now()
+        self.next_poll_at = self.last_polled +\
+            datetime.timedelta(minutes=self.get_polling_interval())
+        self.consecutive_failures = 0
+
+    def get_polling_interval(self):
+        return self.polling_interval
+
+    def record_failure(self, error):
+        """
+        Record a failed poll, and back off exponentially before the next one.
+        Only the failure fields are saved, so anything the failed poll changed
+        on this object is thrown away.
+        """
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        self.last_failure_at = timezone.now()
+        threshold = settings.FETCH_CIRCUIT_BREAKER_THRESHOLD
+        if self.consecutive_failures >= threshold:
+            backoff = settings.FETCH_BACKOFF_MAX
+        else:
+            backoff = min(
+                settings.FETCH_BACKOFF_BASE *
+                2 ** (self.consecutive_failures - 1),
+                settings.FETCH_BACKOFF_MAX,
+            )
+        self.next_poll_at = self.last_failure_at +\
+            datetime.timedelta(minutes=backoff)
+        self.save(update_fields=[
+            'consecutive_failures',
+            'last_error',
+            'last_failure_at',
+            'next_poll_at',
+        ])
+
+    @property
+    def subclass_field(self):
+        return SOURCE_TO_FIELD[self.source_type] + 'source'
+
     @property
     def subclass(self):
         if self.__class__ == MessageSource:
-            field = SOURCE_TO_FIELD[self.source_type] + 'source'
-            return getattr(self, field)
+            return getattr(self, self.subclass_field)
         else:
             return self
 
@@ -136,7 +390,7 @@ FORUMSOURCE_TYPE_CHOICES = (
     (FORUMSOURCE_TYPE_TOPIC_POSTS, 'New Posts in this Topic'),
 )
 
-class ForumSource(MessageSource):
+class ForumSource(FeedSourceMixin, MessageSource):
     """
     A forum post from a specific JudgeApps forum.
     """
@@ -173,39 +427,30 @@ class ForumSource(MessageSource):
             return settings.JUDGEAPPS_BASE_URL +\
                 f'/forum/feed/topic/{self.source_id}/latest_posts/'
 
-    def get_new_announcements(self, sync=False, **kwargs):
-        if not sync and\
-           self.last_polled and\
-           timezone.now() <= self.last_polled +\
-                             datetime.timedelta(minutes=self.polling_interval):
+    def get_new_announcements(self, sync=False, timeout=None, **kwargs):
+        if not sync and not self.poll_due():
             # Already polled within the interval, don't poll again yet.
             return
 
-        # TODO: Find a way to do this only when needed and store the cookies in
-        # redis or something
-        br = mechanize.Browser()
-        br.set_handle_robots(False)
-        br.open(settings.JUDGEAPPS_BASE_URL + '/accounts/login/')
-        br.select_form(nr=0)
-        br["username"] = settings.JUDGEAPPS_USERNAME
-        br["password"] = settings.JUDGEAPPS_PASSWORD
-        br.submit()
-        res2 = br.open(self.feed_url)
-
-        d = feedparser.parse(res2.read())
-
-        for entry in d.entries:
-            if ForumAnnouncement.objects.filter(url=entry.link, source=self):
-                continue
-            entry_datetime = datetime.datetime.strptime(
-                entry.published,
-                "%Y-%m-%dT%H:%M:%S%z",
-            )
-            if entry_datetime < self.created_at:
-                continue
-            text = bleach.clean(entry.summary, tags=['a'])
-            text = html.unescape(text)
-            text = markdownify(text)
+        res = judgeapps.get_session().open(
+            self.feed_url,
+            headers=self.get_conditional_headers(),
+            timeout=timeout,
+        )
+        if res.code == 304:
+            # Nothing has changed since the last poll.
+            self.save_announcements([])
+            return
+        self.set_validators(res.info())
+        d = feedparser.parse(res.read())
+
+        new_entries = self.get_new_entries(
+            d.entries,
+            "%Y-%m-%dT%H:%M:%S%z",
+        )
+        announcements = []
+        for entry_datetime, entry in new_entries:
+            text = sanitize.html_to_markdown(entry.summary)
             announcement = ForumAnnouncement(
                 source=self,
                 headline=entry.title,
@@ -215,19 +460,24 @@ class ForumSource(MessageSource):
                 author_url=entry.author_detail.href,
                 post_datetime=entry_datetime,
             )
-            announcement.save()
-        self.last_polled = timezone.now()
-        self.save()
+            announcements.append(announcement)
+        self.save_announcements(announcements)
 
     def save(self, *args, **kwargs):
         self.source_type = SOURCE_TYPE_APPS_FORUM
+        if self.next_poll_at is None:
+            self.next_poll_at = timezone.now()
         super().save(*args, **kwargs)
 
     def __str__(self):
         return f'ForumSource {self.id} - {self.name} (JA source {self.source_id})'
 
 
-class BlogSource(MessageSource):
+# How long the hub has to verify a subscription request.
+WEBSUB_PENDING_TIMEOUT = datetime.timedelta(hours=1)
+
+
+class BlogSource(FeedSourceMixin, MessageSource):
     """
     A blog post from a specific Judge Blog.
     """
@@ -246,35 +496,120 @@ class BlogSource(MessageSource):
         help_text="Last successful poll",
     )
 
-    def get_new_announcements(self, sync=False, **kwargs):
-        if not sync and\
-           self.last_polled and\
-           timezone.now() <= self.last_polled +\
-                             datetime.timedelta(minutes=self.polling_interval):
+    websub_hub = models.URLField(
+        blank=True, default='',
+        help_text="WebSub hub advertised by the feed",
+    )
+    websub_topic = models.URLField(
+        blank=True, default='',
+        help_text="WebSub topic URL of the feed",
+    )
+    websub_secret = models.CharField(
+        max_length=64, blank=True, default='',
+        help_text="Secret used to sign content pushed by the hub",
+    )
+    websub_expires = models.DateTimeField(
+        null=True, blank=True,
+        help_text="When our WebSub subscription runs out",
+    )
+    websub_callback_token = models.CharField(
+        max_length=64, blank=True, default='',
+        help_text="Secret part of our callback URL, so that only the hub "
+                  "knows it",
+    )
+    websub_pending_at = models.DateTimeField(
+        null=True, blank=True,
+        help_text="When we last asked the hub to subscribe us, until the hub "
+                  "verifies it",
+    )
+
+    @property
+    def websub_active(self):
+        return self.websub_expires is not None and\
+            self.websub_expires > timezone.now()
+
+    @property
+    def websub_callback_url(self):
+        return settings.WEBSUB_BASE_URL +\
+            reverse('websub_callback', kwargs={'pk': self.id}) +\
+            '?' + urlencode({'token': self.websub_callback_token})
+
+    @property
+    def websub_pending(self):
+        """
+        Whether we have asked the hub to subscribe us recently enough that it
+        might still be verifying it.
+        """
+        return self.websub_pending_at is not None and\
+            self.websub_pending_at > timezone.now() - WEBSUB_PENDING_TIMEOUT
+
+    def verify_websub_callback(self, token):
+        return bool(self.websub_callback_token) and\
+            hmac.compare_digest(self.websub_callback_token, token or '')
+
+    def get_polling_interval(self):
+        # While the hub is pushing new posts to us, polling is only a fallback
+        # in case we miss something.
+        if self.websub_active:
+            return max(self.polling_interval,
+                       settings.WEBSUB_FALLBACK_POLLING_INTERVAL)
+        return self.polling_interval
+
+    def get_new_announcements(self, sync=False, timeout=None, deadline=None,
+                              **kwargs):
+        if not sync and not self.poll_due():
             # Already polled within the interval, don't poll again yet.
             return
 
-        # TODO: Find a way to do this only when needed and store the cookies in
-        # redis or something
-        d = feedparser.parse(self.feed_url)
-
-        for entry in d.entries:
-            if BlogAnnouncement.objects.filter(url=entry.link, source=self):
-                continue
-            entry_datetime = datetime.datetime.strptime(
-                entry.published,
-                "%a, %d %b %Y %H:%M:%S %z",
-            )
-            if entry_datetime < self.created_at:
-                continue
-            text = bleach.clean(entry.content[0].value, tags=['a'])
-            text = html.unescape(text)
-            text = markdownify(text)
-            res = requests.get(entry.link)
-            res.raise_for_status()
-            match = re.search('<html lang="(.+?)"', res.text)
-            if not match:
-                raise Exception("Can't find language code for blog post.")
+        # Fetch the feed ourselves rather than handing the URL to feedparser,
+        # which has no way to set a timeout.
+        res = http_client.get(
+            self.feed_url,
+            headers=self.get_conditional_headers(),
+            timeout=timeout,
+        )
+        if res.status_code == 304:
+            # Nothing has changed since the last poll.
+            self.save_announcements([])
+            return
+        res.raise_for_status()
+        self.set_validators(res.headers)
+        d = feedparser.parse(res.content)
+        self.ingest_feed(d, timeout=timeout, deadline=deadline)
+        try:
+            self.maybe_subscribe(d, timeout=timeout)
+        except Exception:
+            # Polling still works without the subscription, don't count this
+            # as a failed poll.
+            logger.exception('Error subscribing %s to its WebSub hub', self)
+
+    def ingest_feed(self, d, timeout=None, polled=True, deadline=None):
+        """
+        Create Announcements for any new entries in a parsed feed, whether we
+        polled it or it was pushed to us by the WebSub hub. Fetching each
+        post's page, to find its language, is the slow part, so only the
+        oldest FETCH_MAX_ENTRIES are taken, and none after the time.monotonic()
+        deadline. The rest are left for the next poll, which has to fetch the
+        whole feed again to see them.
+        """
+        new_entries = self.get_new_entries(
+            d.entries,
+            "%a, %d %b %Y %H:%M:%S %z",
+        )
+        new_entries.reverse()
+        announcements = []
+        for entry_datetime, entry in new_entries:
+            page_timeout = timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                page_timeout = min(timeout or remaining, remaining)
+            if len(announcements) >= settings.FETCH_MAX_ENTRIES:
+                break
+            text = sanitize.html_to_markdown(entry.content[0].value)
+            language_tag = languages.get_entry_language(
+                entry, d.feed, timeout=page_timeout)
             announcement = BlogAnnouncement(
                 source=self,
                 headline=entry.title,
@@ -282,14 +617,81 @@ class BlogSource(MessageSource):
                 url=entry.link,
                 author_name=entry.author,
                 post_datetime=entry_datetime,
-                language_tag=match.group(1),
+                language_tag=language_tag,
             )
-            announcement.save()
-        self.last_polled = timezone.now()
-        self.save()
+            announcements.append(announcement)
+        if len(announcements) < len(new_entries):
+            logger.warning('Only took %s of %s new entries from %s, leaving '
+                           'the rest for the next poll',
+                           len(announcements), len(new_entries), self)
+            self.etag = ''
+            self.last_modified = ''
+            if not polled:
+                self.__class__.objects.filter(pk=self.pk).update(
+                    etag='', last_modified='')
+        self.save_announcements(announcements, polled=polled)
+
+    def maybe_subscribe(self, d, timeout=None):
+        """
+        Subscribe to the feed's WebSub hub, if it advertises one and we don't
+        already have a subscription that will last until the next poll. The
+        hub confirms the subscription by calling WebSubCallbackView.
+        """
+        if not settings.WEBSUB_BASE_URL:
+            return
+        links = {link.get('rel'): link.get('href')
+                 for link in d.feed.get('links', [])}
+        if not links.get('hub'):
+            return
+        renew_by = timezone.now() + datetime.timedelta(
+            minutes=settings.WEBSUB_FALLBACK_POLLING_INTERVAL * 2)
+        if self.websub_hub == links['hub'] and self.websub_expires and\
+           self.websub_expires > renew_by:
+            return
+
+        self.websub_hub = links['hub']
+        self.websub_topic = links.get('self') or self.feed_url
+        if not self.websub_secret:
+            self.websub_secret = secrets.token_hex(32)
+        if not self.websub_callback_token:
+            self.websub_callback_token = secrets.token_urlsafe(32)
+        self.websub_pending_at = timezone.now()
+        self.save(update_fields=['websub_hub', 'websub_topic',
+                                 'websub_secret', 'websub_callback_token',
+                                 'websub_pending_at'])
+        res = http_client.post(
+            self.websub_hub,
+            data={
+                'hub.mode': 'subscribe',
+                'hub.topic': self.websub_topic,
+                'hub.callback': self.websub_callback_url,
+                'hub.secret': self.websub_secret,
+                'hub.lease_seconds': settings.WEBSUB_LEASE_SECONDS,
+            },
+            timeout=timeout,
+        )
+        res.raise_for_status()
+
+    def verify_websub_signature(self, body, signature):
+        """
+        Check the X-Hub-Signature header of content pushed by the hub, which is
+        an HMAC of the body using our secret, like 'sha1=<hex digest>'.
+        """
+        method, _, digest = signature.partition('=')
+        if not self.websub_secret or\
+           method not in ('sha1', 'sha256', 'sha384', 'sha512'):
+            return False
+        expected = hmac.new(
+            self.websub_secret.encode(),
+            body,
+            method,
+        ).hexdigest()
+        return hmac.compare_digest(expected, digest)
 
     def save(self, *args, **kwargs):
         self.source_type = SOURCE_TYPE_BLOG
+        if self.next_poll_at is None:
+            self.next_poll_at = timezone.now()
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -328,10 +730,9 @@ class ExemplarSource(MessageSource):
     )
 
     def get_new_announcements(self, sync=False, **kwargs):
-        # if not sync and\
-        #    self.last_polled and\
-        #    timezone.now() <= self.last_polled +\
-        #                      datetime.timedelta(minutes=self.polling_interval):
+        if not sync and not self.poll_due():
+            # Already polled within the interval, don't poll again yet.
+            return
         # TODO: Update the current wave info from JudgeApps
 
         announcement_days = (14, 7, 3)
@@ -351,10 +752,13 @@ class ExemplarSource(MessageSource):
             )
             announcement.save()
             self.last_reminder = announcement_to_send
-            self.save()
+        self.schedule_next_poll()
+        self.save()
 
     def save(self, *args, **kwargs):
         self.source_type = SOURCE_TYPE_EXEMPLAR
+        if self.next_poll_at is None:
+            self.next_poll_at = timezone.now()
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -372,6 +776,19 @@ class SourceRouting(CreatedUpdatedMixin, models.Model):
     destination = models.ForeignKey('Destination', on_delete=models.CASCADE)
     source = models.ForeignKey(MessageSource, on_delete=models.CASCADE)
 
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        super().save(*args, **kwargs)
+        if created:
+            # A new routing only applies to announcements created after it,
+            # but one of those might have been routed before this was saved,
+            # so have the router take another look at them.
+            Announcement.objects.filter(
+                source_id=self.source_id,
+                created_at__gte=self.created_at,
+                routed=True,
+            ).update(routed=False)
+
     def __str__(self):
         return f'Routing {self.id} - "{self.source.subclass}" to ' +\
                f'"{self.destination.subclass}"'
@@ -386,6 +803,14 @@ DESTINATION_TO_FIELD = {
 }
 
 
+class DestinationUnavailable(Exception):
+    """
+    Raised when delivery fails in a way that won't fix itself, for example
+    because the Slack channel was archived or the app was uninstalled. The
+    destination is suspended until an admin clears it.
+    """
+
+
 class Destination(CreatedUpdatedMixin, models.Model):
     """
     Base class representing a place where announcements can be sent. Each
@@ -411,17 +836,58 @@ class Destination(CreatedUpdatedMixin, models.Model):
         help_text="Language codes to send to this destination. Only affects "
                   "announcements that are generally translated, like Judge "
                   "Blogs. Defaults to English. Select multiple languages "
-                  "using commas, like 'en-US,de-DE'.",
+                  "using commas, like 'en-US,de-DE'. A code without a region, "
+                  "like 'de', matches every region.",
+    )
+
+    consecutive_failures = models.IntegerField(
+        default=0,
+        help_text="Number of deliveries in a row that have failed",
     )
+    last_error = models.TextField(
+        blank=True, default='',
+        help_text="Error from the most recent failed delivery",
+    )
+    suspended = models.BooleanField(
+        default=False, db_index=True,
+        help_text="Delivery failed permanently, nothing is routed or "
+                  "delivered here until this is cleared",
+    )
+    suspended_at = models.DateTimeField(null=True, blank=True)
+
+    objects = SubclassQuerySet.as_manager()
+
+    @property
+    def subclass_field(self):
+        return DESTINATION_TO_FIELD[self.destination_type] + 'destination'
 
     @property
     def subclass(self):
         if self.__class__ == Destination:
-            field = DESTINATION_TO_FIELD[self.destination_type] + 'destination'
-            return getattr(self, field)
+            return getattr(self, self.subclass_field)
         else:
             return self
 
+    def record_success(self):
+        if self.consecutive_failures:
+            self.consecutive_failures = 0
+            self.save(update_fields=['consecutive_failures'])
+
+    def record_failure(self, error):
+        """
+        Record a failed delivery. If it failed permanently, suspend this
+        destination, so that the router and delivery jobs skip it.
+        """
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        update_fields = ['consecutive_failures', 'last_error']
+        if isinstance(error, DestinationUnavailable):
+            logger.warning('Suspending %s: %r', self, error)
+            self.suspended = True
+            self.suspended_at = timezone.now()
+            update_fields += ['suspended', 'suspended_at']
+        self.save(update_fields=update_fields)
+
     def maybe_add_default_sources(self):
         routes = SourceRouting.objects.filter(destination=self)
         if not routes:
@@ -442,10 +908,14 @@ class Destination(CreatedUpdatedMixin, models.Model):
     # Currently checks language settings, however, more things (quiet hours?)
     # could be checked here in the future.
     def wants(self, announcement):
-        if announcement.subclass.get_language_tag():
-            if announcement.subclass.get_language_tag() not in self.language_tags:
-                return False
-        return True
+        return self.wants_language(announcement.subclass.get_language_tag())
+
+    @cached_property
+    def language_tag_set(self):
+        return languages.parse_language_tags(self.language_tags)
+
+    def wants_language(self, language_tag):
+        return languages.language_matches(language_tag, self.language_tag_set)
 
     def deliver(self, message):
         raise NotImplementedError()
@@ -454,15 +924,42 @@ class Destination(CreatedUpdatedMixin, models.Model):
         return f'Destination {self.id} - {self.name}'
 
 
+# Slack answers a webhook with one of these when it will never work again,
+# because the channel or the app is gone.
+SLACK_PERMANENT_STATUSES = {404, 410}
+SLACK_PERMANENT_ERRORS = {
+    'action_prohibited',
+    'channel_is_archived',
+    'channel_not_found',
+    'invalid_token',
+    'no_service',
+    'no_service_id',
+    'no_team',
+    'team_disabled',
+}
+
+
 class SlackDestination(Destination):
     team_id = models.CharField(max_length=32)
     channel_id = models.CharField(max_length=32)
     webhook = models.CharField(max_length=160)
 
+    def get_rate_limit_keys(self):
+        # The webhook URL is a secret, and these keys end up in logs and in
+        # the names of cache keys, so the webhook is known by a hash of it.
+        webhook_hash = hashlib.sha256(self.webhook.encode()).hexdigest()[:16]
+        return [f'webhook:{webhook_hash}', f'team:{self.team_id}']
+
     def deliver(self, message):
+        """
+        Post a message to the webhook, paced by the rate limits for the webhook
+        and its team. Raises DeliveryDeferred if it has to wait for them.
+        """
         slack_data = message.announcement.subclass.get_slack_data()
         slack_data = {'blocks': slack_data}
-        response = requests.post(
+        webhook_key, team_key = self.get_rate_limit_keys()
+        ratelimit.limiter.acquire([webhook_key, team_key])
+        response = http_client.post(
             self.webhook,
             data=json.dumps(slack_data),
             headers={'Content-Type': 'application/json'},
@@ -470,12 +967,20 @@ class SlackDestination(Destination):
         if response.status_code == 200:
             message.sent = True
             message.sent_at = timezone.now()
-            message.save()
+        elif response.status_code == 429:
+            retry_after = ratelimit.parse_retry_after(
+                response.headers.get('Retry-After'))
+            logger.warning('Slack rate limited %s for %ss', self, retry_after)
+            ratelimit.limiter.block(webhook_key, retry_after)
+            raise ratelimit.DeliveryDeferred(webhook_key, retry_after)
+        elif response.status_code in SLACK_PERMANENT_STATUSES or\
+                response.text.strip() in SLACK_PERMANENT_ERRORS:
+            raise DestinationUnavailable(
+                f'{response.status_code} {response.text.strip()[:100]}')
         else:
             response.raise_for_status()
-            # TODO: Logging
-            # TODO: Backoff?
-            return
+            raise Exception(f'Unexpected response from Slack: '
+                            f'{response.status_code} {response.text[:100]}')
 
     def save(self, *args, **kwargs):
         self.destination_type = DESTINATION_TYPE_SLACK
@@ -486,8 +991,15 @@ class SlackDestination(Destination):
 
 
 class AdMessageManager(models.Manager):
-    def random(self):
-        return random.choice(self.filter(live=True))
+    def random_text(self):
+        """
+        The text of a random live ad, or None if there aren't any. The live ads
+        are kept in memory, so this doesn't touch the database.
+        """
+        texts = ad_pool.get()
+        if not texts:
+            return None
+        return random.choice(texts)
 
 
 class AdMessage(models.Model):
@@ -508,6 +1020,13 @@ class AdMessage(models.Model):
         return f'AdMessage {self.id} - {self.text}'
 
 
+ad_pool = ProcessCache(
+    'ad_pool',
+    lambda: tuple(AdMessage.objects.filter(live=True)
+                  .values_list('text', flat=True)),
+)
+
+
 class Announcement(CreatedUpdatedMixin, models.Model):
     """
     Base class representing an individual announcement. Each subclass contains
@@ -533,14 +1052,25 @@ class Announcement(CreatedUpdatedMixin, models.Model):
         default='',
     )
 
+    routed = models.BooleanField(
+        default=False, db_index=True,
+        help_text="Whether the router has created Messages for this "
+                  "announcement yet",
+    )
+
+    objects = SubclassQuerySet.as_manager()
+
     def get_language_tag(self):
         return None
 
+    @property
+    def subclass_field(self):
+        return SOURCE_TO_FIELD[self.announcement_type] + 'announcement'
+
     @property
     def subclass(self):
         if self.__class__ == Announcement:
-            field = SOURCE_TO_FIELD[self.announcement_type] + 'announcement'
-            return getattr(self, field)
+            return getattr(self, self.subclass_field)
         else:
             return self
 
@@ -551,12 +1081,64 @@ class Announcement(CreatedUpdatedMixin, models.Model):
         text = re.sub("\n", "\n>", text)
         return text
 
-    def get_slack_data(self):
+    def render_slack_data(self):
+        """
+        Build the Slack blocks for this announcement, apart from the ad, which
+        is different for every message. The last block must be the context
+        block, the ad is added to the end of it.
+        """
         raise NotImplementedError()
 
+    def get_slack_data_timeout(self):
+        return settings.SLACK_DATA_CACHE_TIMEOUT
+
+    def get_rendered_slack_data(self):
+        """
+        Rendering is the same for every destination, so it's done once and
+        cached, keyed by when the announcement was last changed. Don't modify
+        the result, it's shared.
+        """
+        data = getattr(self, '_slack_data', None)
+        if data is None:
+            key = f'slack_data:{self.id}:{self.updated_at.timestamp()}'
+            data = cache.get(key)
+            if data is None:
+                data = self.subclass.render_slack_data()
+                cache.set(key, data, self.subclass.get_slack_data_timeout())
+            self._slack_data = data
+        return data
+
+    def get_slack_data(self):
+        """
+        The Slack blocks for one message of this announcement, which is the
+        cached rendering plus an ad picked for this message, if there are any.
+        """
+        data = copy.deepcopy(self.get_rendered_slack_data())
+        ad_text = AdMessage.objects.random_text()
+        if ad_text:
+            data[-1]['elements'].append({
+                'type': 'mrkdwn',
+                'text': ad_text,
+            })
+        return data
+
     def __str__(self):
         return f'Announcement {self.id}'
 
+    class Meta:
+        constraints = [
+            # A feed entry can be seen by a poll and a WebSub push at the same
+            # time, or pushed twice, so make sure only one of them saves it.
+            models.UniqueConstraint(
+                fields=['source', 'url'],
+                condition=models.Q(announcement_type__in=[
+                    SOURCE_TYPE_APPS_FORUM,
+                    SOURCE_TYPE_BLOG,
+                ]),
+                name='unique_feed_announcement_url',
+            ),
+        ]
+
 
 class ManualAnnouncement(Announcement):
     """
@@ -565,7 +1147,7 @@ class ManualAnnouncement(Announcement):
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
-    def get_slack_data(self):
+    def render_slack_data(self):
         data = []
         if self.headline:
             data.append({
@@ -606,10 +1188,6 @@ class ManualAnnouncement(Announcement):
                 {
                     'type': 'mrkdwn',
                     'text': f"Submitted on {self.created_at.strftime('%Y-%m-%d %H:%M:%S')} (UTC) by {self.user.get_full_name()}",
-                },
-                {
-                    'type': 'mrkdwn',
-                    'text': AdMessage.objects.random().text,
                 }
             ]
         })
@@ -631,7 +1209,7 @@ class ForumAnnouncement(Announcement):
     author_url = models.TextField()
     post_datetime = models.DateTimeField()
 
-    def get_slack_data(self):
+    def render_slack_data(self):
         data = []
         source = self.source.subclass
         if source.forumsource_type == FORUMSOURCE_TYPE_FORUM_TOPICS:
@@ -677,10 +1255,6 @@ class ForumAnnouncement(Announcement):
                 {
                     'type': 'mrkdwn',
                     'text': f"Posted to the JudgeApps forum on {self.post_datetime.strftime('%Y-%m-%d %H:%M:%S')} (UTC)",
-                },
-                {
-                    'type': 'mrkdwn',
-                    'text': AdMessage.objects.random().text,
                 }
             ]
         })
@@ -705,7 +1279,7 @@ class BlogAnnouncement(Announcement):
     def get_language_tag(self):
         return self.language_tag
 
-    def get_slack_data(self):
+    def render_slack_data(self):
         data = []
         source = self.source.subclass
         data.append({
@@ -742,10 +1316,6 @@ class BlogAnnouncement(Announcement):
                 {
                     'type': 'mrkdwn',
                     'text': f"Posted to the MagicJudges Blogs on {self.post_datetime.strftime('%Y-%m-%d %H:%M:%S')} (UTC)",
-                },
-                {
-                    'type': 'mrkdwn',
-                    'text': AdMessage.objects.random().text,
                 }
             ]
         })
@@ -791,7 +1361,12 @@ class ExemplarAnnouncement(Announcement):
     def timedelta(self):
         return NaturalTimeFormatter.string_for(self.wave_deadline)
 
-    def get_slack_data(self):
+    def get_slack_data_timeout(self):
+        # The text says how long is left until the deadline, so it can't be
+        # kept for long.
+        return 60
+
+    def render_slack_data(self):
         data = []
         source = self.source.subclass
         data.append({
@@ -825,10 +1400,6 @@ class ExemplarAnnouncement(Announcement):
                 {
                     'type': 'mrkdwn',
                     'text': f"Automatically sent by the Judge Announcements app",
-                },
-                {
-                    'type': 'mrkdwn',
-                    'text': AdMessage.objects.random().text,
                 }
             ]
         })
@@ -842,6 +1413,19 @@ class ExemplarAnnouncement(Announcement):
         return f'ExemplarAnnouncement {self.id}'
 
 
+class MessageManager(models.Manager):
+    def delivery_latencies(self, since):
+        """
+        The time from each announcement being created to its Message being
+        sent, in seconds, for Messages sent since the given time. Sorted, so
+        that callers can take percentiles.
+        """
+        messages = self.filter(sent=True, sent_at__gte=since)\
+            .values_list('sent_at', 'announcement__created_at')
+        return sorted((sent_at - created_at).total_seconds()
+                      for sent_at, created_at in messages)
+
+
 class Message(CreatedUpdatedMixin, models.Model):
     """
     Class representing an individual announcement going to an individual
@@ -852,9 +1436,78 @@ class Message(CreatedUpdatedMixin, models.Model):
     sent = models.BooleanField(default=False)
     sent_at = models.DateTimeField(null=True, blank=True)
 
+    attempts = models.IntegerField(
+        default=0,
+        help_text="Failed delivery attempts so far.",
+    )
+    last_error = models.TextField(
+        blank=True,
+        help_text="The error from the most recent failed delivery attempt.",
+    )
+    next_attempt_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="When this message is next due to be delivered.",
+    )
+    dead = models.BooleanField(
+        default=False,
+        help_text="Delivery failed too many times, and won't be retried.",
+    )
+    claimed_by = models.CharField(
+        max_length=100, blank=True,
+        help_text="The delivery worker that is currently sending this "
+                  "message.",
+    )
+    lease_expires = models.DateTimeField(
+        null=True, blank=True,
+        help_text="When the current worker's claim on this message runs out, "
+                  "and another worker may take it over.",
+    )
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent', 'dead', 'next_attempt_at']),
+        ]
+
+    @property
+    def delivery_latency(self):
+        if not self.sent_at:
+            return None
+        return self.sent_at - self.announcement.created_at
+
     def deliver(self):
+        """
+        Send this message to its destination. On success, sent and sent_at are
+        set, but not saved, so that the caller can save them in bulk.
+        """
         self.source_routing.destination.subclass.deliver(self)
 
+    def record_failure(self, error):
+        """
+        Record a failed delivery, and back off exponentially before the next
+        one. After DELIVERY_MAX_ATTEMPTS failures, give up on the message. Like
+        deliver, this doesn't save anything.
+        """
+        self.attempts += 1
+        self.last_error = repr(error)
+        if self.attempts >= settings.DELIVERY_MAX_ATTEMPTS:
+            self.dead = True
+            return
+        backoff = min(
+            settings.DELIVERY_BACKOFF_BASE * 2 ** (self.attempts - 1),
+            settings.DELIVERY_BACKOFF_MAX,
+        )
+        self.next_attempt_at = timezone.now() +\
+            datetime.timedelta(minutes=backoff)
+
+    def defer(self, seconds):
+        """
+        Put off delivering this message, without counting it as a failure.
+        """
+        self.next_attempt_at = timezone.now() +\
+            datetime.timedelta(seconds=seconds)
+
     def __str__(self):
         return f'Message {self.id} - {self.announcement.subclass} ' +\
                f'to {self.source_routing.destination.subclass}'
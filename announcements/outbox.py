@@ -0,0 +1,104 @@
+import logging
+import os
+import socket
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_connection():
+    return get_redis_connection('default')
+
+
+def get_consumer_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def publish(message_ids):
+    """
+    Add Message IDs to the outbox stream, for the delivery workers to pick up.
+    The stream is only a notification, the database still says what needs to
+    be sent, so if this fails the delivery sweep will find them anyway.
+    """
+    if not message_ids:
+        return
+    try:
+        pipe = get_connection().pipeline(transaction=False)
+        for message_id in message_ids:
+            pipe.xadd(
+                settings.OUTBOX_STREAM,
+                {'message_id': message_id},
+                maxlen=settings.OUTBOX_MAXLEN,
+                approximate=True,
+            )
+        pipe.execute()
+    except Exception:
+        logger.exception('Error adding %s messages to the outbox',
+                         len(message_ids))
+
+
+def ensure_group(connection):
+    try:
+        connection.xgroup_create(settings.OUTBOX_STREAM, settings.OUTBOX_GROUP,
+                                 id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def parse_entries(entries):
+    """
+    Turn a list of (entry ID, fields) from the stream into a dict of entry ID
+    to Message ID.
+    """
+    parsed = {}
+    for entry_id, fields in entries:
+        try:
+            parsed[entry_id] = int(fields[b'message_id'])
+        except (KeyError, ValueError):
+            # Nothing we can deliver, but it still needs acknowledging.
+            parsed[entry_id] = None
+    return parsed
+
+
+def read(connection, consumer, block=None):
+    """
+    Read the next batch of entries for this consumer, waiting up to block
+    milliseconds for one to arrive. Entries that another consumer read but
+    never acknowledged, because it died, are taken over once they've been
+    pending for longer than a delivery lease.
+    """
+    pending = connection.xpending_range(
+        settings.OUTBOX_STREAM, settings.OUTBOX_GROUP,
+        min='-', max='+', count=settings.OUTBOX_BATCH_SIZE,
+    )
+    if pending:
+        # XCLAIM only takes the entries that have been idle for at least the
+        # lease, checking that itself, so entries that their consumer is still
+        # working on, or has just acknowledged, are left alone.
+        claimed = connection.xclaim(
+            settings.OUTBOX_STREAM, settings.OUTBOX_GROUP, consumer,
+            settings.DELIVERY_LEASE_SECONDS * 1000,
+            [entry['message_id'] for entry in pending],
+        )
+        if claimed:
+            return parse_entries(claimed)
+
+    response = connection.xreadgroup(
+        settings.OUTBOX_GROUP, consumer, {settings.OUTBOX_STREAM: '>'},
+        count=settings.OUTBOX_BATCH_SIZE, block=block,
+    )
+    entries = []
+    for stream, stream_entries in response or []:
+        entries.extend(stream_entries)
+    return parse_entries(entries)
+
+
+def ack(connection, entry_ids):
+    if entry_ids:
+        connection.xack(settings.OUTBOX_STREAM, settings.OUTBOX_GROUP,
+                        *entry_ids)
@@ -0,0 +1,40 @@
+import threading
+import uuid
+
+from django.core.cache import cache
+
+
+class ProcessCache():
+    """
+    A value built from the database and kept in memory by each process, for
+    configuration that is read constantly but rarely changes. The shared cache
+    holds a version token for it. invalidate() replaces the token, and every
+    process rebuilds its copy the next time it asks for the value.
+    """
+
+    def __init__(self, name, build):
+        self.version_key = f'process_cache_version:{name}'
+        self.build = build
+        self.lock = threading.Lock()
+        self.version = None
+        self.value = None
+
+    def get_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        return version
+
+    def get(self):
+        # Read the version before building, so that if the data changes while
+        # we're building, we'll notice next time and build again.
+        version = self.get_version()
+        with self.lock:
+            if self.version is None or self.version != version:
+                self.value = self.build()
+                self.version = version
+            return self.value
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid.uuid4().hex, None)
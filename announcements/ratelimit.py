@@ -0,0 +1,145 @@
+import datetime
+import email.utils
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+
+CACHE_KEY_PREFIX = 'rate_limited:'
+
+# Slack always sends Retry-After with a 429, but just in case it doesn't.
+DEFAULT_RETRY_AFTER = 30
+
+
+class DeliveryDeferred(Exception):
+    """
+    Raised when a message can't be sent yet because of a rate limit. The
+    message should be tried again later, rather than counted as a failure.
+    """
+
+    def __init__(self, key, retry_after):
+        # Only the kind of key goes in the message, which gets logged.
+        kind = key.split(':', 1)[0]
+        super().__init__(f'{kind} is rate limited for {retry_after:.1f}s')
+        self.key = key
+        self.retry_after = retry_after
+
+
+class TokenBucket():
+    """
+    Allows rate requests per second on average, with bursts of up to capacity
+    requests. Not thread safe by itself, RateLimiter holds a lock around it.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """
+        How long until a token is available, after anything already reserved.
+        """
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        # Tokens can go negative, which reserves future tokens for requests
+        # that are already waiting.
+        self.refill()
+        self.tokens -= 1
+
+    def drain(self, seconds):
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateLimiter():
+    """
+    Token buckets for each webhook and each Slack team, kept by each process,
+    plus the Retry-After periods that Slack gives us, which are kept in the
+    shared cache so that every worker respects them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def get_bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            kind = key.split(':', 1)[0]
+            if kind == 'team':
+                bucket = TokenBucket(settings.SLACK_TEAM_RATE,
+                                     settings.SLACK_TEAM_BURST)
+            else:
+                bucket = TokenBucket(settings.SLACK_WEBHOOK_RATE,
+                                     settings.SLACK_WEBHOOK_BURST)
+            self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, keys):
+        """
+        Wait until a request can be made for every key, and reserve it. If
+        Slack has told us to back off from one of them, or the wait would be
+        longer than DELIVERY_MAX_WAIT seconds, raise DeliveryDeferred instead.
+        """
+        now = timezone.now()
+        blocked = cache.get_many([CACHE_KEY_PREFIX + key for key in keys])
+        for key in keys:
+            until = blocked.get(CACHE_KEY_PREFIX + key)
+            if until and until > now:
+                raise DeliveryDeferred(key, (until - now).total_seconds())
+
+        with self.lock:
+            buckets = [(key, self.get_bucket(key)) for key in keys]
+            key, wait = max(((key, bucket.wait_time())
+                             for key, bucket in buckets),
+                            key=lambda pair: pair[1])
+            if wait > settings.DELIVERY_MAX_WAIT:
+                raise DeliveryDeferred(key, wait)
+            for key, bucket in buckets:
+                bucket.take()
+        if wait:
+            time.sleep(wait)
+
+    def block(self, key, retry_after):
+        """
+        Record that Slack has rate limited key for retry_after seconds.
+        """
+        with self.lock:
+            self.get_bucket(key).drain(retry_after)
+        until = timezone.now() + datetime.timedelta(seconds=retry_after)
+        cache.set(CACHE_KEY_PREFIX + key, until, retry_after)
+
+
+def parse_retry_after(value):
+    """
+    Retry-After is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max((when - timezone.now()).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+limiter = RateLimiter()
@@ -0,0 +1,71 @@
+import collections
+
+from announcements import languages
+from announcements.models import SourceRouting
+from announcements.process_cache import ProcessCache
+
+
+RoutingEntry = collections.namedtuple(
+    'RoutingEntry',
+    ['routing_id', 'destination_id', 'language_tags', 'created_at'],
+)
+
+# Every RoutingEntry for a source, and the same entries indexed by each of the
+# language ranges that their destination wants.
+SourceRoutes = collections.namedtuple(
+    'SourceRoutes',
+    ['entries', 'by_language'],
+)
+
+
+def build_routing_table():
+    """
+    Compile every SourceRouting into a dict of source ID to SourceRoutes, with
+    each destination's language settings already parsed. Suspended
+    destinations are left out.
+    """
+    table = {}
+    routings = SourceRouting.objects.select_related('destination')\
+        .filter(destination__suspended=False).order_by('id')
+    for routing in routings:
+        entry = RoutingEntry(
+            routing_id=routing.id,
+            destination_id=routing.destination_id,
+            language_tags=routing.destination.language_tag_set,
+            created_at=routing.created_at,
+        )
+        routes = table.setdefault(
+            routing.source_id,
+            SourceRoutes(entries=[], by_language={}),
+        )
+        routes.entries.append(entry)
+        for language_tag in entry.language_tags:
+            routes.by_language.setdefault(language_tag, []).append(entry)
+    return table
+
+
+routing_table = ProcessCache('routing_table', build_routing_table)
+
+
+def get_routings(announcement, language_tag):
+    """
+    Return the RoutingEntries that an announcement should be sent to, without
+    touching the database. Routings only apply to announcements created after
+    them. For an announcement in a particular language, we look up the
+    destinations that want it in the language index, rather than checking
+    every routing.
+    """
+    routes = routing_table.get().get(announcement.source_id)
+    if not routes:
+        return []
+    if not language_tag:
+        candidates = routes.entries
+    else:
+        candidates = {}
+        for prefix in languages.language_tag_prefixes(language_tag):
+            for entry in routes.by_language.get(prefix, ()):
+                candidates[entry.routing_id] = entry
+        candidates = sorted(candidates.values(),
+                            key=lambda entry: entry.routing_id)
+    return [entry for entry in candidates
+            if entry.created_at <= announcement.created_at]
@@ -0,0 +1,53 @@
+import bleach
+import collections
+import hashlib
+import html
+import threading
+from markdownify import markdownify
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+CACHE_KEY_PREFIX = 'html_to_markdown:'
+
+_local_cache = collections.OrderedDict()
+_local_cache_lock = threading.Lock()
+
+
+def convert_html_to_markdown(value):
+    """
+    Strip everything except links from a chunk of feed HTML, and convert it to
+    the Markdown that we send to Slack. This is the expensive part, callers
+    should normally use html_to_markdown, which caches it.
+    """
+    text = bleach.clean(value, tags=['a'])
+    text = html.unescape(text)
+    return markdownify(text)
+
+
+def html_to_markdown(value):
+    """
+    Cached version of convert_html_to_markdown, keyed by a hash of the HTML.
+    The same content often turns up more than once, for example in both the
+    forum topics and forum posts feeds, so we keep recent results in a small
+    LRU cache in this process, and in the shared cache for other workers.
+    """
+    digest = hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    with _local_cache_lock:
+        if digest in _local_cache:
+            _local_cache.move_to_end(digest)
+            return _local_cache[digest]
+
+    key = CACHE_KEY_PREFIX + digest
+    text = cache.get(key)
+    if text is None:
+        text = convert_html_to_markdown(value)
+        cache.set(key, text, settings.SANITIZE_CACHE_TIMEOUT)
+
+    with _local_cache_lock:
+        _local_cache[digest] = text
+        while len(_local_cache) > settings.SANITIZE_CACHE_SIZE:
+            _local_cache.popitem(last=False)
+    return text
@@ -0,0 +1,57 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django_q.tasks import async_task
+
+from announcements import models
+from announcements.routing import routing_table
+
+
+logger = logging.getLogger(__name__)
+
+HEALTH_FIELDS = {'consecutive_failures', 'last_error'}
+
+
+@receiver(post_save, sender=models.SourceRouting)
+@receiver(post_delete, sender=models.SourceRouting)
+@receiver(post_save, sender=models.Destination)
+@receiver(post_delete, sender=models.Destination)
+@receiver(post_save, sender=models.SlackDestination)
+@receiver(post_delete, sender=models.SlackDestination)
+def invalidate_routing_table(sender, update_fields=None, **kwargs):
+    # Delivery failures are recorded on the destination all the time, but
+    # they don't change the routing table unless it gets suspended.
+    if update_fields and not set(update_fields) - HEALTH_FIELDS:
+        return
+    # Wait for the commit, otherwise another process could rebuild the table
+    # from the old data and keep it.
+    transaction.on_commit(routing_table.invalidate)
+
+
+@receiver(post_save, sender=models.AdMessage)
+@receiver(post_delete, sender=models.AdMessage)
+def invalidate_ad_pool(sender, **kwargs):
+    transaction.on_commit(models.ad_pool.invalidate)
+
+
+def queue_route_and_deliver(announcement_id):
+    try:
+        async_task('announcements.workers.route_and_deliver', announcement_id)
+    except Exception:
+        # The announcement is already saved, so the router and delivery jobs
+        # will still send it, just not as quickly.
+        logger.exception('Error queueing announcement %s', announcement_id)
+
+
+@receiver(post_save, sender=models.ManualAnnouncement)
+@receiver(post_save, sender=models.ForumAnnouncement)
+@receiver(post_save, sender=models.BlogAnnouncement)
+@receiver(post_save, sender=models.ExemplarAnnouncement)
+def route_new_announcement(sender, instance, created, **kwargs):
+    if not created:
+        return
+    # The task runs in another process, so it can't see the announcement until
+    # this transaction commits.
+    transaction.on_commit(lambda: queue_route_and_deliver(instance.id))
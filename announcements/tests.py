@@ -0,0 +1,584 @@
+import datetime
+import hashlib
+import hmac
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from announcements import models, outbox, ratelimit, workers
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for the services we talk to: a WebSub hub at /hub/, blog post
+    pages at /post/<language>/, and Slack incoming webhooks at /hook/<name>/.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=b'', content_type='text/plain',
+                headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/post/'):
+            language = self.path.split('/')[2]
+            body = f'<html lang="{language}"><head></head></html>'
+            self.respond(200, body.encode(), 'text/html')
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        if self.path == '/hub/':
+            server.subscriptions.append(
+                dict(urllib.parse.parse_qsl(body.decode())))
+            self.respond(202)
+        elif self.path.startswith('/hook/'):
+            with server.lock:
+                server.posts.append((self.path, json.loads(body)))
+            # (status, text) or (status, text, headers)
+            status, text, *headers = server.hook_responses.get(
+                self.path, (200, 'ok'))
+            self.respond(status, text.encode(), headers=dict(*headers))
+        else:
+            self.respond(404)
+
+
+class StubServerMixin():
+    """
+    Runs a StubHandler server on a free local port for each test class.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     StubHandler)
+        cls.server.lock = threading.Lock()
+        cls.server.daemon_threads = True
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.server.subscriptions = []
+        self.server.posts = []
+        self.server.hook_responses = {}
+
+
+def blog_feed(base_url, posts):
+    """
+    An RSS feed advertising our stub hub, with a (slug, language, datetime)
+    for each post.
+    """
+    items = ''.join(f"""
+        <item>
+          <title>{slug}</title>
+          <link>{base_url}/post/{language}/{slug}/</link>
+          <pubDate>{when.strftime('%a, %d %b %Y %H:%M:%S +0000')}</pubDate>
+          <dc:creator>Author</dc:creator>
+          <content:encoded><![CDATA[<p>Post {slug}</p>]]></content:encoded>
+        </item>""" for slug, language, when in posts)
+    return f"""<?xml version="1.0"?>
+    <rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/"
+         xmlns:atom="http://www.w3.org/2005/Atom">
+      <channel>
+        <title>Blog</title>
+        <language>en-US</language>
+        <atom:link rel="hub" href="{base_url}/hub/"/>
+        <atom:link rel="self" href="{base_url}/feed/"/>
+        {items}
+      </channel>
+    </rss>""".encode()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, WEBSUB_BASE_URL='http://testserver')
+class WebSubTests(StubServerMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.source = models.BlogSource.objects.create(
+            name='Blog',
+            description='A blog',
+            feed_url=f'{self.base_url}/feed/',
+        )
+        self.source.created_at = timezone.now() - datetime.timedelta(days=1)
+        self.source.save()
+
+    def subscribe(self):
+        import feedparser
+        self.source.maybe_subscribe(feedparser.parse(
+            blog_feed(self.base_url, [])))
+        return self.server.subscriptions[-1]
+
+    def verify(self, callback, mode='subscribe', **params):
+        # The test client drops the query string from the path when it's
+        # given data, so the callback token has to go in with the rest.
+        path, _, callback_query = callback.partition('?')
+        query = dict(urllib.parse.parse_qsl(callback_query))
+        query.update({
+            'hub.mode': mode,
+            'hub.topic': self.source.websub_topic,
+            'hub.challenge': 'challenge',
+            'hub.lease_seconds': '3600',
+        })
+        query.update(params)
+        return self.client.get(path, query)
+
+    def test_subscription_is_verified_once(self):
+        subscription = self.subscribe()
+        callback = subscription['hub.callback']
+        self.assertIn('token=', callback)
+
+        response = self.verify(callback)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'challenge')
+        self.source.refresh_from_db()
+        self.assertTrue(self.source.websub_active)
+        self.assertIsNone(self.source.websub_pending_at)
+
+        # The request has been used up, so the lease can't be extended.
+        response = self.verify(callback, **{'hub.lease_seconds': '99999999'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_verification_needs_callback_token(self):
+        subscription = self.subscribe()
+        callback = subscription['hub.callback'].split('?')[0]
+        self.assertEqual(self.verify(callback).status_code, 404)
+        self.assertEqual(self.verify(callback, token='guess').status_code,
+                         404)
+        self.source.refresh_from_db()
+        self.assertFalse(self.source.websub_active)
+
+    def test_unrequested_subscription_is_rejected(self):
+        subscription = self.subscribe()
+        models.BlogSource.objects.filter(id=self.source.id).update(
+            websub_pending_at=None)
+        response = self.verify(subscription['hub.callback'])
+        self.assertEqual(response.status_code, 404)
+
+    def push(self, body, secret):
+        signature = hmac.new(secret.encode(), body, hashlib.sha256)\
+            .hexdigest()
+        return self.client.post(
+            f'/websub/{self.source.id}/',
+            body,
+            content_type='application/rss+xml',
+            HTTP_X_HUB_SIGNATURE=f'sha256={signature}',
+        )
+
+    @mock.patch('announcements.views.async_task')
+    def test_push_with_bad_signature_is_ignored(self, async_task):
+        self.subscribe()
+        body = blog_feed(self.base_url, [('post', 'en-US', timezone.now())])
+        response = self.push(body, 'wrong secret')
+        self.assertEqual(response.status_code, 202)
+        async_task.assert_not_called()
+
+    @mock.patch('announcements.signals.async_task')
+    @mock.patch('announcements.views.async_task')
+    def test_push_is_queued_and_ingested(self, async_task, signals_task):
+        self.subscribe()
+        self.source.refresh_from_db()
+        body = blog_feed(self.base_url, [('post', 'de-DE', timezone.now())])
+        response = self.push(body, self.source.websub_secret)
+        self.assertEqual(response.status_code, 202)
+        # The view answers the hub without fetching anything.
+        self.assertFalse(models.BlogAnnouncement.objects.exists())
+        async_task.assert_called_once_with(
+            'announcements.workers.ingest_websub_push', self.source.id, body)
+
+        workers.ingest_websub_push(self.source.id, body)
+        announcement = models.BlogAnnouncement.objects.get()
+        self.assertEqual(announcement.language_tag, 'de-DE')
+
+        # The hub retrying the same push doesn't add it again.
+        workers.ingest_websub_push(self.source.id, body)
+        self.assertEqual(models.BlogAnnouncement.objects.count(), 1)
+
+    @mock.patch('announcements.signals.async_task')
+    def test_entry_is_only_saved_once(self, async_task):
+        # A poll and a push that both checked for the entry before either of
+        # them saved it.
+        def announcement():
+            return models.BlogAnnouncement(
+                source=self.source,
+                headline='post',
+                url=f'{self.base_url}/post/en-US/post/',
+                author_name='Author',
+                post_datetime=timezone.now(),
+                language_tag='en-US',
+            )
+        self.source.save_announcements([announcement()])
+        stale = models.BlogSource.objects.get(id=self.source.id)
+        stale.save_announcements([announcement()], polled=False)
+        self.assertEqual(models.BlogAnnouncement.objects.count(), 1)
+
+    @mock.patch('announcements.signals.async_task')
+    def test_push_doesnt_overwrite_poll_state(self, async_task):
+        import feedparser
+        stale = models.BlogSource.objects.get(id=self.source.id)
+        next_poll_at = timezone.now() + datetime.timedelta(hours=1)
+        models.BlogSource.objects.filter(id=self.source.id).update(
+            etag='"from-a-poll"',
+            next_poll_at=next_poll_at,
+            consecutive_failures=2,
+        )
+        posted = timezone.now().replace(microsecond=0)
+        stale.ingest_feed(
+            feedparser.parse(blog_feed(self.base_url,
+                                       [('post', 'en-US', posted)])),
+            polled=False,
+        )
+        self.source.refresh_from_db()
+        self.assertEqual(self.source.etag, '"from-a-poll"')
+        self.assertEqual(self.source.next_poll_at, next_poll_at)
+        self.assertEqual(self.source.consecutive_failures, 2)
+        self.assertEqual(self.source.last_entry_datetime, posted)
+
+
+# Fast enough that the rate limits never make the tests wait.
+FAST_RATE_LIMITS = {
+    'SLACK_WEBHOOK_RATE': 1000,
+    'SLACK_WEBHOOK_BURST': 1000,
+    'SLACK_TEAM_RATE': 1000,
+    'SLACK_TEAM_BURST': 1000,
+}
+
+
+class DeliveryTestMixin():
+    """
+    A ManualSource routed to a couple of Slack destinations, whose webhooks are
+    on the stub server. Delivery uses a thread for each destination, which
+    needs its own database connection, so these are TransactionTestCases.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Rate limit blocks are kept in the cache, and buckets in memory.
+        cache.clear()
+        ratelimit.limiter.buckets.clear()
+        self.user = User.objects.create_user('judge')
+        self.source = models.ManualSource.objects.create(
+            name='Manual',
+            description='Manual',
+        )
+        self.destinations = []
+        for i in range(2):
+            destination = models.SlackDestination.objects.create(
+                name=f'Destination {i}',
+                team_id='T0',
+                channel_id=f'C{i}',
+                webhook=f'{self.base_url}/hook/{i}/',
+            )
+            models.SourceRouting.objects.create(destination=destination,
+                                                source=self.source)
+            self.destinations.append(destination)
+
+    def announce(self, *headlines):
+        for headline in headlines:
+            models.ManualAnnouncement.objects.create(
+                source=self.source,
+                user=self.user,
+                headline=headline,
+            )
+        workers.route_announcements()
+
+    def posted_headlines(self, path):
+        return [body['blocks'][0]['text']['text']
+                for hook, body in self.server.posts if hook == path]
+
+
+@override_settings(CACHES=LOCMEM_CACHES, **FAST_RATE_LIMITS)
+@mock.patch('announcements.signals.async_task')
+class DeliveryOrderTests(DeliveryTestMixin, StubServerMixin,
+                         TransactionTestCase):
+    def test_each_destination_gets_announcements_in_order(self, async_task):
+        self.announce(*map(str, range(5)))
+        report = workers.deliver_messages(sync=True)
+        self.assertEqual(report['sent'], 10)
+        expected = [f'*Manual: {i}*' for i in range(5)]
+        for i in range(2):
+            self.assertEqual(self.posted_headlines(f'/hook/{i}/'), expected)
+
+    def test_failure_holds_back_later_messages(self, async_task):
+        self.announce(*map(str, range(3)))
+        self.server.hook_responses['/hook/0/'] = (500, 'oops')
+        report = workers.deliver_messages()
+        self.assertEqual(report['sent'], 3)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['deferred'], 2)
+        # Only the first message was tried, the rest wait for it.
+        self.assertEqual(self.posted_headlines('/hook/0/'), ['*Manual: 0*'])
+
+        # A message that arrives while they're backing off waits too, even
+        # though the webhook works again.
+        del self.server.hook_responses['/hook/0/']
+        self.server.posts = []
+        self.announce('3')
+        report = workers.deliver_messages()
+        self.assertEqual(report['sent'], 1)
+        self.assertEqual(self.posted_headlines('/hook/0/'), [])
+        self.assertTrue(models.Message.objects.get(
+            announcement__manualannouncement__headline='3',
+            source_routing__destination=self.destinations[0],
+        ).next_attempt_at <= timezone.now())
+
+        self.server.posts = []
+        workers.deliver_messages(sync=True)
+        self.assertEqual(self.posted_headlines('/hook/0/'),
+                         [f'*Manual: {i}*' for i in range(4)])
+        self.assertFalse(models.Message.objects.filter(sent=False).exists())
+
+    def test_backing_off_holds_back_newer_messages(self, async_task):
+        self.announce('first')
+        self.server.hook_responses['/hook/0/'] = (500, 'oops')
+        workers.deliver_messages()
+        del self.server.hook_responses['/hook/0/']
+        self.server.posts = []
+
+        # Destination 0 waits for the first message's retry, destination 1
+        # isn't held up by it.
+        self.announce('second')
+        report = workers.deliver_messages()
+        self.assertEqual(report['sent'], 1)
+        self.assertEqual(self.posted_headlines('/hook/0/'), [])
+        self.assertEqual(self.posted_headlines('/hook/1/'),
+                         ['*Manual: second*'])
+
+        models.Message.objects.filter(sent=False).update(
+            next_attempt_at=timezone.now())
+        workers.deliver_messages()
+        self.assertEqual(self.posted_headlines('/hook/0/'),
+                         ['*Manual: first*', '*Manual: second*'])
+
+
+    def test_new_announcement_waits_for_older_messages(self, async_task):
+        # Routed by the sweep, but not delivered yet.
+        self.announce('first')
+        announcement = models.ManualAnnouncement.objects.create(
+            source=self.source,
+            user=self.user,
+            headline='second',
+        )
+        workers.route_and_deliver(announcement.id)
+        for i in range(2):
+            self.assertEqual(self.posted_headlines(f'/hook/{i}/'),
+                             ['*Manual: first*', '*Manual: second*'])
+
+        self.server.hook_responses['/hook/0/'] = (500, 'oops')
+        self.announce('third')
+        workers.deliver_messages()
+        del self.server.hook_responses['/hook/0/']
+        self.server.posts = []
+        announcement = models.ManualAnnouncement.objects.create(
+            source=self.source,
+            user=self.user,
+            headline='fourth',
+        )
+        workers.route_and_deliver(announcement.id)
+        self.assertEqual(self.posted_headlines('/hook/0/'), [])
+        self.assertEqual(self.posted_headlines('/hook/1/'),
+                         ['*Manual: fourth*'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, **FAST_RATE_LIMITS)
+@mock.patch('announcements.signals.async_task')
+class SlackResponseTests(DeliveryTestMixin, StubServerMixin,
+                         TransactionTestCase):
+    def message_for(self, destination):
+        return models.Message.objects.get(
+            source_routing__destination=destination)
+
+    def test_rate_limited_message_is_deferred(self, async_task):
+        self.announce('0')
+        self.server.hook_responses['/hook/0/'] = (
+            429, 'rate_limited', {'Retry-After': '120'})
+        started = timezone.now()
+        report = workers.deliver_messages()
+        self.assertEqual(report['sent'], 1)
+        self.assertEqual(report['deferred'], 1)
+        self.assertEqual(report['failed'], 0)
+
+        message = self.message_for(self.destinations[0])
+        self.assertFalse(message.sent)
+        self.assertEqual(message.attempts, 0)
+        self.assertGreaterEqual(message.next_attempt_at,
+                                started + datetime.timedelta(seconds=120))
+        self.assertLess(message.next_attempt_at,
+                        timezone.now() + datetime.timedelta(seconds=125))
+        self.destinations[0].refresh_from_db()
+        self.assertEqual(self.destinations[0].consecutive_failures, 0)
+
+        # Until the Retry-After has passed, nothing more is sent to it, even
+        # when the message is due.
+        del self.server.hook_responses['/hook/0/']
+        self.server.posts = []
+        models.Message.objects.filter(id=message.id).update(
+            next_attempt_at=timezone.now())
+        report = workers.deliver_messages()
+        self.assertEqual(report['deferred'], 1)
+        self.assertEqual(self.posted_headlines('/hook/0/'), [])
+
+
+    def assert_suspends(self, response):
+        self.announce('0', '1')
+        self.server.hook_responses['/hook/0/'] = response
+        report = workers.deliver_messages()
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual(report['suspended'], 2)
+        self.assertEqual(self.posted_headlines('/hook/0/'), ['*Manual: 0*'])
+
+        destination = self.destinations[0]
+        destination.refresh_from_db()
+        self.assertTrue(destination.suspended)
+        self.assertIsNotNone(destination.suspended_at)
+        # Its messages are kept, but nothing picks them up.
+        self.assertEqual(models.Message.objects.filter(
+            source_routing__destination=destination,
+            sent=False,
+            dead=False,
+        ).count(), 2)
+        self.assertFalse(workers.unsent_messages(sync=True).exists())
+
+        # New announcements aren't routed to it.
+        self.announce('2')
+        self.assertEqual(models.Message.objects.filter(
+            announcement__manualannouncement__headline='2',
+        ).get().source_routing.destination_id, self.destinations[1].id)
+
+    def test_missing_webhook_suspends_destination(self, async_task):
+        self.assert_suspends((404, 'no_service'))
+
+    def test_archived_channel_suspends_destination(self, async_task):
+        self.assert_suspends((400, 'channel_not_found'))
+
+    def test_other_errors_dont_suspend_destination(self, async_task):
+        self.announce('0')
+        self.server.hook_responses['/hook/0/'] = (500, 'oops')
+        report = workers.deliver_messages()
+        self.assertEqual(report['failed'], 1)
+        self.destinations[0].refresh_from_db()
+        self.assertFalse(self.destinations[0].suspended)
+        self.assertEqual(self.destinations[0].consecutive_failures, 1)
+
+    def test_resume_delivery(self, async_task):
+        self.assert_suspends((410, ''))
+        del self.server.hook_responses['/hook/0/']
+        self.server.posts = []
+
+        admin = User.objects.create_superuser('admin', 'admin@example.com',
+                                              'password')
+        self.client.force_login(admin)
+        response = self.client.post(
+            '/admin/announcements/slackdestination/',
+            {
+                'action': 'resume_delivery',
+                '_selected_action': [self.destinations[0].id],
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        destination = self.destinations[0]
+        destination.refresh_from_db()
+        self.assertFalse(destination.suspended)
+        self.assertEqual(destination.consecutive_failures, 0)
+
+        # The messages it was holding go out in order, and new announcements
+        # are routed to it again.
+        self.announce('3')
+        workers.deliver_messages()
+        self.assertEqual(self.posted_headlines('/hook/0/'),
+                         ['*Manual: 0*', '*Manual: 1*', '*Manual: 3*'])
+
+
+@skipUnless(fakeredis, 'Needs fakeredis')
+@override_settings(CACHES=LOCMEM_CACHES, DELIVERY_OUTBOX=True,
+                   **FAST_RATE_LIMITS)
+@mock.patch('announcements.signals.async_task')
+class OutboxTests(DeliveryTestMixin, StubServerMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        patcher = mock.patch('announcements.outbox.get_connection',
+                             return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pending(self):
+        return self.redis.xpending(settings.OUTBOX_STREAM,
+                                   settings.OUTBOX_GROUP)['pending']
+
+    def test_routing_publishes_and_delivery_acknowledges(self, async_task):
+        self.announce('0', '1')
+        message_ids = set(models.Message.objects.values_list('id', flat=True))
+        published = self.redis.xrange(settings.OUTBOX_STREAM)
+        self.assertEqual(set(outbox.parse_entries(published).values()),
+                         message_ids)
+
+        report = workers.deliver_outbox(sync=True)
+        self.assertEqual(report['sent'], 4)
+        self.assertEqual(self.pending(), 0)
+        for i in range(2):
+            self.assertEqual(self.posted_headlines(f'/hook/{i}/'),
+                             ['*Manual: 0*', '*Manual: 1*'])
+
+    def test_unacknowledged_entries_are_taken_over(self, async_task):
+        self.announce('0')
+        outbox.ensure_group(self.redis)
+        entries = outbox.read(self.redis, 'dead-consumer')
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(self.pending(), 2)
+
+        # Not stale yet, so another consumer doesn't get them.
+        self.assertEqual(outbox.read(self.redis, 'live-consumer'), {})
+
+        time.sleep(0.01)
+        with override_settings(DELIVERY_LEASE_SECONDS=0):
+            taken = outbox.read(self.redis, 'live-consumer')
+        self.assertEqual(taken, entries)
+        consumers = self.redis.xpending_range(
+            settings.OUTBOX_STREAM, settings.OUTBOX_GROUP,
+            min='-', max='+', count=10,
+        )
+        self.assertEqual({c['consumer'] for c in consumers},
+                         {b'live-consumer'})
+
+        outbox.ack(self.redis, list(taken))
+        self.assertEqual(self.pending(), 0)
@@ -1,21 +1,30 @@
 import datetime
 import json
-import requests
+import logging
 from urllib.parse import quote_plus
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.core.exceptions import PermissionDenied
 from django.core.signing import Signer
-from django.http import HttpResponseRedirect
+from django.db.models import Prefetch
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
-from django.views.generic import (TemplateView,
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import (View,
+                                  TemplateView,
                                   ListView,
                                   DetailView,
                                   CreateView,
                                   DeleteView)
-from announcements import jobs, models, forms
+from django_q.tasks import async_task
+from announcements import forms, http_client, jobs, models
+
+
+logger = logging.getLogger(__name__)
 
 
 class StatusView(UserPassesTestMixin, TemplateView):
@@ -29,15 +38,55 @@ class StatusView(UserPassesTestMixin, TemplateView):
         context['fetch_job'] = jobs.AnnouncementFetchJob()
         context['router_job'] = jobs.MessageRouterJob()
         context['delivery_job'] = jobs.MessageDeliveryJob()
+        context['failing_sources'] = models.MessageSource.objects.filter(
+            consecutive_failures__gt=0,
+        )
+        context['suspended_destinations'] = \
+            models.Destination.objects.filter(suspended=True)
+        # Each row shows the Message's announcement and destination.
+        context['dead_messages'] = models.Message.objects.filter(
+            sent=False,
+            dead=True,
+        ).select_related(
+            *(f'announcement__{field}announcement'
+              for field in models.SOURCE_TO_FIELD.values()),
+            *(f'source_routing__destination__{field}destination'
+              for field in models.DESTINATION_TO_FIELD.values()),
+        ).order_by('-id')[:20]
+        context['delivery_latency'] = self.get_delivery_latency()
         return context
 
+    def get_delivery_latency(self):
+        """
+        Summarize how long announcements took to reach Slack over the last day,
+        from being created to their Message being sent.
+        """
+        since = timezone.now() - datetime.timedelta(days=1)
+        latencies = models.Message.objects.delivery_latencies(since)
+        if not latencies:
+            return None
+
+        def percentile(p):
+            return round(latencies[int(p * (len(latencies) - 1))], 1)
+
+        return {
+            'count': len(latencies),
+            'median': percentile(0.5),
+            'p90': percentile(0.9),
+            'max': round(latencies[-1], 1),
+        }
+
 
 class DestinationList(LoginRequiredMixin, ListView):
     model = models.Destination
     template_name = 'announcements/destination_list.html'
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().with_subclasses().prefetch_related(
+            'admins',
+            Prefetch('message_types',
+                     queryset=models.MessageSource.objects.with_subclasses()),
+        )
         if not self.request.user.is_superuser:
             queryset = queryset.filter(admins=self.request.user)
         return queryset
@@ -58,15 +107,18 @@ class DestinationDetail(LoginRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['available_sources'] = models.MessageSource.objects.all()
-        context['selected_sources'] = [o.subclass for o in self.object.message_types.all()]
+        context['available_sources'] = \
+            models.MessageSource.objects.with_subclasses()
+        context['selected_sources'] = [
+            o.subclass for o in self.object.message_types.with_subclasses()]
         return context
 
     def post(self, *args, **kwargs):
         self.object = self.get_object()
 
         # Process POST data
-        current_sources = [o.subclass for o in self.object.message_types.all()]
+        current_sources = [
+            o.subclass for o in self.object.message_types.with_subclasses()]
         selected_source_ids = []
         for key in self.request.POST:
             if key.startswith('ms_'):
@@ -77,7 +129,8 @@ class DestinationDetail(LoginRequiredMixin, DetailView):
                     pass
         selected_sources = [
             o.subclass for o in
-            models.MessageSource.objects.filter(id__in=selected_source_ids)]
+            models.MessageSource.objects.filter(id__in=selected_source_ids)
+            .with_subclasses()]
 
         for current_source in current_sources:
             if current_source not in selected_sources:
@@ -211,7 +264,7 @@ class SlackCallbackView(LoginRequiredMixin, TemplateView):
         redirect_uri = redirect_uri +\
             request.get_host() + '/slack/callback/'
 
-        response = requests.get(
+        response = http_client.get(
             'https://slack.com/api/oauth.access',
             params={
                 'client_id': settings.SLACK_CLIENT_ID,
@@ -261,3 +314,55 @@ class SlackCallbackView(LoginRequiredMixin, TemplateView):
         context['destination'] = self.destination
 
         return context
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class WebSubCallbackView(View):
+    """
+    Callback for a BlogSource's WebSub hub. The hub calls GET to verify that
+    we asked to (un)subscribe, and POSTs the updated feed whenever the blog
+    publishes something, which we ingest just like a poll.
+    """
+
+    def get(self, request, pk):
+        source = get_object_or_404(models.BlogSource, pk=pk)
+        mode = request.GET.get('hub.mode')
+        topic = request.GET.get('hub.topic')
+        # Only the hub knows the token in our callback URL, and we only accept
+        # a subscription that we asked for recently.
+        if not source.verify_websub_callback(request.GET.get('token')) or\
+           not source.websub_topic or topic != source.websub_topic:
+            return HttpResponse(status=404)
+
+        if mode == 'subscribe' and source.websub_pending:
+            try:
+                lease_seconds = int(request.GET.get('hub.lease_seconds'))
+            except (TypeError, ValueError):
+                lease_seconds = settings.WEBSUB_LEASE_SECONDS
+            lease_seconds = min(lease_seconds, settings.WEBSUB_LEASE_SECONDS)
+            source.websub_expires = timezone.now() +\
+                datetime.timedelta(seconds=lease_seconds)
+        elif mode == 'denied':
+            source.websub_expires = None
+        else:
+            return HttpResponse(status=404)
+        source.websub_pending_at = None
+        source.save(update_fields=['websub_expires', 'websub_pending_at'])
+        return HttpResponse(request.GET.get('hub.challenge', ''),
+                            content_type='text/plain')
+
+    def post(self, request, pk):
+        source = get_object_or_404(models.BlogSource, pk=pk)
+        signature = request.META.get('HTTP_X_HUB_SIGNATURE', '')
+        # The spec says to acknowledge content with a bad signature anyway,
+        # but we mustn't act on it. Ingesting it means fetching each new post,
+        # which could take longer than the hub will wait, so it's queued.
+        if source.verify_websub_signature(request.body, signature):
+            try:
+                async_task('announcements.workers.ingest_websub_push',
+                           source.id, request.body)
+            except Exception:
+                # The next fallback poll will still find the new posts.
+                logger.exception('Error queueing WebSub content for %s',
+                                 source)
+        return HttpResponse(status=202)
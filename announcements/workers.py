@@ -1,9 +1,138 @@
-from announcements.models import MessageSource, Announcement, Message
+import collections
+import datetime
+import feedparser
+import logging
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from announcements.models import (MessageSource,
+                                  BlogSource,
+                                  Announcement,
+                                  Destination,
+                                  Message,
+                                  DESTINATION_TO_FIELD,
+                                  SOURCE_TO_FIELD)
+from announcements import outbox, ratelimit, routing
+
+
+logger = logging.getLogger(__name__)
+
+
+def poll_source(source, sync=False):
+    """
+    Check a single MessageSource for new announcements, and report how long it
+    took and whether it worked. Failures are recorded on the source, which
+    backs off before it's due again, rather than stopping the whole run. This
+    runs in a worker thread, which gets its own database connection, so we
+    close that connection when we're done.
+    """
+    started = time.monotonic()
+    try:
+        source.get_new_announcements(
+            sync=sync,
+            timeout=settings.FETCH_TIMEOUT,
+            deadline=started + settings.FETCH_DEADLINE,
+        )
+        outcome = 'ok'
+    except Exception as e:
+        logger.exception('Error fetching announcements from %s', source)
+        source.record_failure(e)
+        outcome = f'error: {e!r}'
+    finally:
+        connection.close()
+    duration = time.monotonic() - started
+    logger.info('Polled %s in %.2fs: %s', source, duration, outcome)
+    return {
+        'source': str(source),
+        'outcome': outcome,
+        'duration': round(duration, 3),
+    }
 
 
 def fetch_announcements(sync=False):
-    for source in MessageSource.objects.all():
-        source.subclass.get_new_announcements(sync=sync)
+    """
+    Poll every MessageSource that is due, up to FETCH_CONCURRENCY at a time,
+    so that one slow JudgeApps or blog host doesn't hold up all of the others.
+    Sources are selected by their indexed next_poll_at, so sources that aren't
+    due cost nothing, and each source's subclass is fetched in the same query.
+    Running synchronously polls every pollable source right away. Returns a
+    report with the timing and outcome of each source, which django-q stores
+    as the result of the task.
+    """
+    sources = MessageSource.objects.select_related(
+        *(field + 'source' for field in SOURCE_TO_FIELD.values()))
+    if sync:
+        sources = sources.filter(next_poll_at__isnull=False)
+    else:
+        sources = sources.filter(next_poll_at__lte=timezone.now())
+    sources = [source.subclass for source in sources]
+    with ThreadPoolExecutor(max_workers=settings.FETCH_CONCURRENCY) as pool:
+        report = list(pool.map(lambda s: poll_source(s, sync=sync), sources))
+    return report
+
+
+def ingest_websub_push(source_id, body):
+    """
+    Create Announcements from feed content that a WebSub hub pushed to us.
+    WebSubCallbackView has already checked its signature, and queues this so
+    that it can answer the hub straight away.
+    """
+    source = BlogSource.objects.filter(id=source_id).first()
+    if source is None:
+        return
+    source.ingest_feed(
+        feedparser.parse(body),
+        timeout=settings.FETCH_TIMEOUT,
+        polled=False,
+        deadline=time.monotonic() + settings.FETCH_DEADLINE,
+    )
+
+
+def route_announcement(announcement):
+    """
+    Create the Messages for a single announcement, which must already have its
+    subclass loaded. Marking the announcement as routed is a conditional
+    update, done first in the same transaction, so if the sweep and the task
+    queued when the announcement was created both get to it, only one of them
+    creates its Messages. Returns False if it had already been routed.
+    """
+    language_tag = announcement.subclass.get_language_tag()
+    with transaction.atomic():
+        claimed = Announcement.objects.filter(
+            id=announcement.id,
+            routed=False,
+        ).update(routed=True)
+        if not claimed:
+            return False
+        # The routing table is cached in memory, so the only query here is for
+        # the routings that already have a Message for this announcement.
+        existing_routing_ids = set(
+            announcement.message_set.values_list('source_routing_id',
+                                                 flat=True))
+        messages = [
+            Message(source_routing_id=entry.routing_id,
+                    announcement=announcement)
+            for entry in routing.get_routings(announcement, language_tag)
+            if entry.routing_id not in existing_routing_ids
+        ]
+        Message.objects.bulk_create(messages)
+        if settings.DELIVERY_OUTBOX and messages:
+            # bulk_create doesn't set the IDs on every database.
+            message_ids = list(Message.objects.filter(
+                announcement=announcement,
+                source_routing_id__in=[m.source_routing_id for m in messages],
+            ).values_list('id', flat=True))
+            transaction.on_commit(lambda: outbox.publish(message_ids))
+    return True
 
 
 def route_announcements(sync=False):
@@ -13,24 +142,305 @@ def route_announcements(sync=False):
     or do some other special stuff, in order to support use cases like a "quiet
     hours" setting for certain destinations.
 
-    TODO: Maybe also need a filter to not keep checking old Announcements.
+    Only announcements that haven't been routed yet are checked. Saving a new
+    SourceRouting marks any announcements it could apply to as unrouted again.
+    New announcements are normally routed straight away by route_and_deliver,
+    so this is a sweep for anything that missed it.
     """
-    for announcement in Announcement.objects.all():
-        source = announcement.source
-        configured_routings = source.sourcerouting_set.all()
-        created_messages = announcement.message_set.all()
-        created_routings = [m.source_routing for m in created_messages]
-        for routing in configured_routings:
-            if routing not in created_routings:
-                if routing.destination.wants(announcement):
-                    if announcement.created_at >= routing.created_at:
-                        message = Message(
-                            source_routing=routing,
-                            announcement=announcement,
-                        )
-                        message.save()
+    announcements = Announcement.objects.filter(routed=False).select_related(
+        *(field + 'announcement' for field in SOURCE_TO_FIELD.values()))
+    for announcement in announcements:
+        route_announcement(announcement)
+
+
+def route_and_deliver(announcement_id):
+    """
+    Route one new announcement and deliver its Messages right away. This is
+    queued when an announcement is created, so it goes out in seconds instead
+    of waiting for the next runs of the router and delivery jobs. If anything
+    here fails, those jobs will pick up where it left off. In outbox mode,
+    routing puts the Messages in the outbox, and deliver_outbox delivers them.
+    """
+    announcement = Announcement.objects.select_related(
+        *(field + 'announcement' for field in SOURCE_TO_FIELD.values())
+    ).filter(id=announcement_id).first()
+    if announcement is None:
+        return
+    route_announcement(announcement)
+    if not settings.DELIVERY_OUTBOX:
+        deliver(claim_messages(destination_backlog(
+            Message.objects.filter(announcement=announcement))))
+
+
+MESSAGE_DELIVERY_FIELDS = ['sent', 'sent_at', 'attempts', 'last_error',
+                           'next_attempt_at', 'dead', 'claimed_by',
+                           'lease_expires']
+
+
+def unsent_messages(sync=False):
+    """
+    Unsent Messages that are due for delivery. Running synchronously includes
+    Messages that are backing off after a failure. Dead Messages, and Messages
+    for suspended destinations, are never included. Otherwise, a destination
+    with a Message that is backing off is skipped altogether until it's due,
+    so that newer Messages don't go out ahead of it.
+    """
+    messages = Message.objects.filter(
+        sent=False,
+        dead=False,
+        source_routing__destination__suspended=False,
+    )
+    if not sync:
+        now = timezone.now()
+        backing_off = Message.objects.filter(
+            sent=False,
+            dead=False,
+            next_attempt_at__gt=now,
+        ).values('source_routing__destination_id')
+        messages = messages.filter(next_attempt_at__lte=now).exclude(
+            source_routing__destination_id__in=backing_off)
+    return messages
+
+
+def destination_backlog(messages):
+    """
+    Every due Message for the destinations of the given Messages, rather than
+    just those ones, so that claiming them also claims anything older that is
+    waiting for the same destination, and they all go out in order.
+    """
+    return unsent_messages().filter(
+        source_routing__destination_id__in=messages.values(
+            'source_routing__destination_id'))
+
+
+def claim_messages(messages):
+    """
+    Claim the given Messages for this worker, so that other workers delivering
+    at the same time don't send them too. Whole destinations are claimed at a
+    time: up to DELIVERY_CLAIM_LIMIT of the oldest Messages pick which
+    destinations, and then every one of their Messages is claimed, so that
+    only one worker at a time ever sends to a destination, keeping its
+    Messages in order and its rate limits in one process. Destinations that
+    another worker holds a lease on are skipped. A claim is a lease, if this
+    worker dies, the Messages go back to the pool when it expires.
+
+    The claim itself is a conditional update through the same QuerySet, so a
+    Message that another worker has just sent, or put off, can't be claimed
+    again. Where the database supports it, the destination rows are locked
+    while claiming, and ones that another worker is busy claiming are skipped
+    rather than waited for. Returns the claimed Messages, with everything
+    needed to deliver them fetched in the same query.
+    """
+    now = timezone.now()
+    token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    unclaimed = Q(lease_expires__isnull=True) | Q(lease_expires__lte=now)
+    leased_destinations = Message.objects.filter(lease_expires__gt=now)\
+        .values('source_routing__destination_id')
+    available = messages.filter(unclaimed).exclude(
+        source_routing__destination_id__in=leased_destinations)
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    # Without row locks, like on SQLite, a transaction around this only makes
+    # workers fail to upgrade their read locks, and doesn't gain anything.
+    # There, the claim is a single UPDATE, and SQLite runs one at a time.
+    with transaction.atomic() if skip_locked else nullcontext():
+        destination_ids = set(
+            available.order_by('id')
+            .values_list('source_routing__destination_id', flat=True)
+            [:settings.DELIVERY_CLAIM_LIMIT])
+        if skip_locked:
+            destination_ids = list(
+                Destination.objects.filter(id__in=destination_ids)
+                .select_for_update(skip_locked=True)
+                .values_list('id', flat=True))
+        # The UPDATE checks for leases again, in case another worker claimed
+        # one of these destinations and committed since we looked.
+        available.filter(
+            source_routing__destination_id__in=destination_ids,
+        ).update(
+            claimed_by=token,
+            lease_expires=now + datetime.timedelta(
+                seconds=settings.DELIVERY_LEASE_SECONDS),
+        )
+    return list(Message.objects.filter(
+        claimed_by=token,
+        sent=False,
+    ).select_related(
+        *(f'announcement__{field}announcement'
+          for field in SOURCE_TO_FIELD.values()),
+        *(f'source_routing__destination__{field}destination'
+          for field in DESTINATION_TO_FIELD.values()),
+    ).order_by('id'))
+
+
+def deliver_to_destination(messages):
+    """
+    Deliver a list of Messages for one destination, in order, one at a time.
+    A failure backs the Message off and counts towards it being dead, a rate
+    limit just puts it off. Either way, the rest of the list is put off until
+    the same time, so that a destination never gets announcements out of
+    order. If the destination is gone for good, it is suspended, and the rest
+    of the list stays where it is until an admin clears it. Returns each
+    Message with its outcome, none of them saved yet, although the health of
+    the destination is. This runs in a worker thread, so we close its database
+    connection when we're done.
+    """
+    outcomes = []
+    try:
+        destination = messages[0].source_routing.destination
+        for i, message in enumerate(messages):
+            try:
+                message.deliver()
+                outcome = 'sent'
+                logger.info('Delivered %s, %s after it was announced',
+                            message, message.delivery_latency)
+            except ratelimit.DeliveryDeferred as e:
+                logger.info('Deferring %s: %s', message, e)
+                message.defer(e.retry_after)
+                outcome = 'deferred'
+            except Exception as e:
+                logger.exception('Error delivering %s', message)
+                message.record_failure(e)
+                destination.record_failure(e)
+                if destination.suspended:
+                    outcome = 'suspended'
+                elif message.dead:
+                    outcome = 'dead'
+                else:
+                    outcome = 'failed'
+            outcomes.append((message, outcome))
+            if outcome == 'sent':
+                destination.record_success()
+            if outcome in ('deferred', 'failed'):
+                for later in messages[i + 1:]:
+                    later.next_attempt_at = message.next_attempt_at
+                    outcomes.append((later, 'deferred'))
+                break
+            if outcome == 'suspended':
+                for later in messages[i + 1:]:
+                    outcomes.append((later, 'suspended'))
+                break
+    finally:
+        connection.close()
+    for message, outcome in outcomes:
+        message.claimed_by = ''
+        message.lease_expires = None
+    return outcomes
+
+
+def deliver(messages):
+    """
+    Deliver Messages to up to DELIVERY_CONCURRENCY destinations at once, with
+    each destination's Messages going out one at a time, so that their order is
+    kept. The results are saved in batches as they come back, so one broken
+    webhook only holds up its own Messages. Returns a report with the number
+    of Messages sent, put off until later, failed and given up on, and the
+    throughput, which django-q stores as the result of the task.
+    """
+    started = time.monotonic()
+    by_destination = collections.OrderedDict()
+    announcements = {}
+    for message in messages:
+        # Share one instance of each announcement between its Messages, so
+        # that its Slack blocks are only fetched once.
+        message.announcement = announcements.setdefault(
+            message.announcement_id, message.announcement)
+        destination_id = message.source_routing.destination_id
+        by_destination.setdefault(destination_id, []).append(message)
+    for announcement in announcements.values():
+        # If this fails, delivering its Messages will try again, and record
+        # the failure against each of them, rather than stopping the run.
+        try:
+            announcement.subclass.get_rendered_slack_data()
+        except Exception:
+            logger.exception('Error rendering %s', announcement)
+
+    counts = collections.Counter()
+    pending = []
+    with ThreadPoolExecutor(max_workers=settings.DELIVERY_CONCURRENCY) as pool:
+        futures = [pool.submit(deliver_to_destination, group)
+                   for group in by_destination.values()]
+        for future in as_completed(futures):
+            for message, outcome in future.result():
+                counts[outcome] += 1
+                pending.append(message)
+            if len(pending) >= settings.DELIVERY_BATCH_SIZE:
+                Message.objects.bulk_update(pending, MESSAGE_DELIVERY_FIELDS)
+                pending = []
+    if pending:
+        Message.objects.bulk_update(pending, MESSAGE_DELIVERY_FIELDS)
+
+    duration = time.monotonic() - started
+    report = {
+        'destinations': len(by_destination),
+        'sent': counts['sent'],
+        'deferred': counts['deferred'],
+        'failed': counts['failed'],
+        'dead': counts['dead'],
+        'suspended': counts['suspended'],
+        'duration': round(duration, 3),
+        'per_second': round(counts['sent'] / duration, 1) if duration else 0,
+    }
+    if by_destination:
+        logger.info('Delivered %(sent)s messages to %(destinations)s '
+                    'destinations in %(duration)ss, %(deferred)s deferred, '
+                    '%(failed)s failed, %(dead)s dead, %(suspended)s for '
+                    'suspended destinations, %(per_second)s/s',
+                    report)
+    return report
 
 
 def deliver_messages(sync=False):
-    for message in Message.objects.filter(sent=False):
-        message.deliver()
+    """
+    Deliver every Message that is due. In outbox mode, new Messages are
+    delivered from the outbox, so this only sweeps up Messages that have been
+    waiting for longer than OUTBOX_SWEEP_DELAY seconds, which the outbox
+    missed, or which are due to be retried.
+    """
+    messages = unsent_messages(sync=sync)
+    if settings.DELIVERY_OUTBOX and not sync:
+        messages = messages.filter(
+            created_at__lte=timezone.now() -
+            datetime.timedelta(seconds=settings.OUTBOX_SWEEP_DELAY),
+        )
+    return deliver(claim_messages(messages))
+
+
+def deliver_outbox(sync=False, stopping=None):
+    """
+    Deliver Messages as their IDs arrive on the outbox stream. This is the
+    loop of the deliver_outbox management command, which runs in its own
+    process, rather than in the django-q cluster, so that it doesn't hold up
+    the cluster's workers. It runs until stopping(), if given, returns True.
+    Several processes can run this at once, each one reads different entries
+    through the consumer group. An entry is acknowledged once the outcome of
+    its Message is saved, whether or not it was sent, because the database
+    keeps track of retries. Running synchronously just drains what's waiting.
+    Returns a report in the same form as deliver.
+    """
+    if not settings.DELIVERY_OUTBOX:
+        return None
+    stream = outbox.get_connection()
+    outbox.ensure_group(stream)
+    consumer = outbox.get_consumer_name()
+    totals = collections.Counter()
+    while not (stopping and stopping()):
+        # Like a request, each batch shouldn't rely on a connection that the
+        # database may have dropped while we were waiting.
+        close_old_connections()
+        entries = outbox.read(stream, consumer,
+                              block=None if sync else settings.OUTBOX_BLOCK_MS)
+        if entries:
+            message_ids = [message_id for message_id in entries.values()
+                           if message_id is not None]
+            report = deliver(claim_messages(destination_backlog(
+                Message.objects.filter(id__in=message_ids))))
+            outbox.ack(stream, list(entries))
+            totals.update({key: value for key, value in report.items()
+                           if key != 'per_second'})
+        elif sync:
+            break
+    report = dict(totals)
+    report['duration'] = round(report.get('duration', 0), 3)
+    report['per_second'] = round(report.get('sent', 0) / report['duration'], 1)\
+        if report['duration'] else 0
+    return report
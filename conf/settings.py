@@ -108,6 +108,102 @@ Q_CLUSTER = {
     'django_redis': 'default',
 }
 
+# Outbound HTTP requests share one keep-alive connection pool per process.
+# HTTP_TIMEOUT is the default timeout, in seconds, for requests that don't set
+# their own. HTTP_POOL_MAXSIZE should be at least as large as the number of
+# threads making requests at once.
+HTTP_TIMEOUT = 10
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+
+# The fetch job polls up to FETCH_CONCURRENCY sources at once, so that one slow
+# host doesn't hold up every other source. FETCH_TIMEOUT is the timeout, in
+# seconds, applied to each HTTP request made while polling a source. A blog
+# poll also fetches the page of each new post, so it takes at most
+# FETCH_MAX_ENTRIES of them, and stops fetching them FETCH_DEADLINE seconds
+# after the poll started. Anything left over is taken by the next poll.
+FETCH_CONCURRENCY = 4
+FETCH_TIMEOUT = 30
+FETCH_MAX_ENTRIES = 20
+FETCH_DEADLINE = 120
+
+# When a poll fails, the source is retried after FETCH_BACKOFF_BASE minutes,
+# doubling with each further failure up to FETCH_BACKOFF_MAX minutes. After
+# FETCH_CIRCUIT_BREAKER_THRESHOLD failures in a row, the circuit breaker opens
+# and the source is only retried every FETCH_BACKOFF_MAX minutes until a poll
+# succeeds again.
+FETCH_BACKOFF_BASE = 5
+FETCH_BACKOFF_MAX = 60 * 6
+FETCH_CIRCUIT_BREAKER_THRESHOLD = 5
+
+# The delivery job posts to up to DELIVERY_CONCURRENCY destinations at once.
+# Each destination's messages are still sent one at a time, in order. Sent
+# messages are written back to the database in batches of DELIVERY_BATCH_SIZE.
+DELIVERY_CONCURRENCY = 8
+DELIVERY_BATCH_SIZE = 50
+
+# Each delivery run claims up to DELIVERY_CLAIM_LIMIT messages, so that several
+# workers can deliver at once without sending anything twice. If a worker dies,
+# its claim lapses after DELIVERY_LEASE_SECONDS and another worker picks the
+# messages up. The lease must be longer than a delivery run can take.
+DELIVERY_CLAIM_LIMIT = 500
+DELIVERY_LEASE_SECONDS = 60 * 10
+
+# In outbox mode, routing adds new messages to the OUTBOX_STREAM Redis stream,
+# and `manage.py deliver_outbox` delivers them as soon as they arrive, instead
+# of waiting for the delivery job to find them in the database. Run at least
+# one deliver_outbox process alongside the qcluster; it's a separate process
+# so that it doesn't tie up the cluster's workers. The delivery job then only
+# sweeps up messages older than OUTBOX_SWEEP_DELAY seconds, in case the outbox
+# missed them. Needs a Redis server that supports streams, version 5 or later.
+DELIVERY_OUTBOX = False
+OUTBOX_STREAM = 'announcements:outbox'
+OUTBOX_GROUP = 'delivery'
+OUTBOX_MAXLEN = 10000
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_BLOCK_MS = 1000
+OUTBOX_SWEEP_DELAY = 60
+
+# A message that fails to deliver is retried after DELIVERY_BACKOFF_BASE
+# minutes, doubling with each further failure up to DELIVERY_BACKOFF_MAX
+# minutes. After DELIVERY_MAX_ATTEMPTS failures it is marked as dead, and is
+# only retried if an admin asks for it.
+DELIVERY_BACKOFF_BASE = 1
+DELIVERY_BACKOFF_MAX = 60 * 6
+DELIVERY_MAX_ATTEMPTS = 10
+
+# Slack allows about one message per second to each incoming webhook, with
+# short bursts. Deliveries are paced to SLACK_WEBHOOK_RATE messages per second
+# per webhook and SLACK_TEAM_RATE per Slack team, and when Slack does return a
+# 429, nothing more is sent to that webhook until its Retry-After has passed.
+# Rather than wait more than DELIVERY_MAX_WAIT seconds for a rate limit, the
+# message is left for the next delivery run.
+SLACK_WEBHOOK_RATE = 1
+SLACK_WEBHOOK_BURST = 3
+SLACK_TEAM_RATE = 10
+SLACK_TEAM_BURST = 20
+DELIVERY_MAX_WAIT = 5
+
+# The Slack blocks for an announcement are rendered once, and kept in the cache
+# for SLACK_DATA_CACHE_TIMEOUT seconds, for all of its messages to share.
+SLACK_DATA_CACHE_TIMEOUT = 60 * 60
+
+# Blogs that advertise a WebSub hub push new posts to us, but only if
+# WEBSUB_BASE_URL is set to the public URL of this site, for example
+# "https://announcements.example.org", so the hub can reach our callback. While
+# subscribed, a BlogSource only polls every WEBSUB_FALLBACK_POLLING_INTERVAL
+# minutes, in case a push goes missing. Hubs may grant a shorter lease than
+# WEBSUB_LEASE_SECONDS; we renew it from the fallback polls.
+WEBSUB_BASE_URL = ''
+WEBSUB_LEASE_SECONDS = 60 * 60 * 24 * 7
+WEBSUB_FALLBACK_POLLING_INTERVAL = 60 * 6
+
+# Converting feed HTML to Markdown is cached by a hash of the content, keeping
+# SANITIZE_CACHE_SIZE results in each process and keeping results in the shared
+# cache for SANITIZE_CACHE_TIMEOUT seconds.
+SANITIZE_CACHE_SIZE = 256
+SANITIZE_CACHE_TIMEOUT = 60 * 60 * 24
+
 WSGI_APPLICATION = 'wsgi.application'
 
 
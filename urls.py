@@ -64,4 +64,7 @@ urlpatterns = [
 
     path('slack/', views.SlackConnectView.as_view(), name='slack_connect'),
     path('slack/callback/', views.SlackCallbackView.as_view(), name='slack_callback'),
+
+    path('websub/<int:pk>/', views.WebSubCallbackView.as_view(),
+         name='websub_callback'),
 ]